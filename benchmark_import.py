@@ -0,0 +1,205 @@
+"""Times import_photos() against a stub osascript, so changes to how imports
+are batched, polled and timed out can be compared on any platform
+(including Linux, without Photos or AppleScript).
+
+A configurable stub osascript is written to the work directory and put
+first on PATH. It reads the import folder from the generated AppleScript and
+simulates Photos importing it: a start-up delay, a delay per file, lines of
+stdout/stderr chatter per file and optionally hanging before it exits. Each
+run records when the stub started and finished, so the time import_photos()
+spends waiting beyond the simulated import can be separated out. A stub
+still running a margin after the completion timeout is killed, so the time
+import_photos() keeps waiting past its timeout is measured rather than
+blocking the benchmark."""
+
+from contextlib import redirect_stdout
+from pathlib import Path
+import argparse
+import io
+import json
+import os
+import signal
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import google_photos_sync_mac as sync
+
+default_batch_sizes = '1,10,100,1000'
+default_work_dir = Path(tempfile.gettempdir()) / 'google-photos-sync-mac-import-benchmark'
+default_startup_latency = 1.0 # seconds
+default_file_latency = 0.01 # seconds
+default_chatter_lines = 0
+default_hang_time = 0.0 # seconds
+default_repeats = 3
+default_kill_margin = 5.0 # seconds
+stub_log_file_name = 'stub-log.jsonl'
+stub_pid_file_name = 'stub.pid'
+
+# Run by the interpreter running the benchmark, configured by environment
+stub_osascript = """#!{python}
+import json, os, sys, time
+start_time = time.time()
+with open(os.environ['STUB_PID'], 'w') as pid_file:
+    pid_file.write(str(os.getpid()))
+folder = None
+with open(sys.argv[1]) as script:
+    for line in script:
+        if line.startswith('set importFolder to alias "'):
+            folder = line.split('"')[1].replace('Macintosh HD', '', 1).replace(':', '/')
+files = os.listdir(folder) if folder else []
+time.sleep(float(os.environ['STUB_STARTUP_LATENCY']))
+for filename in files:
+    time.sleep(float(os.environ['STUB_FILE_LATENCY']))
+    for line in range(int(os.environ['STUB_CHATTER_LINES'])):
+        print('importing {{}} ({{}})'.format(filename, line), flush=True)
+        print('warning: {{}} ({{}})'.format(filename, line), file=sys.stderr, flush=True)
+time.sleep(float(os.environ['STUB_HANG_TIME']))
+with open(os.environ['STUB_LOG'], 'a') as log:
+    log.write(json.dumps({{'start': start_time, 'end': time.time(), 'files': len(files)}}) + '\\n')
+"""
+
+def install_stub(work_dir, startup_latency, file_latency, chatter_lines, hang_time):
+    """Writes the stub osascript to work_dir/bin, puts it first on PATH and
+    configures it. Returns the path of the log it appends a line to for each
+    import (its pid is written alongside, see stub_pid_path())."""
+    bin_dir = work_dir / 'bin'
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    stub_path = bin_dir / 'osascript'
+    stub_path.write_text(stub_osascript.format(python=sys.executable))
+    stub_path.chmod(0o755)
+
+    stub_log_path = work_dir / stub_log_file_name
+    os.environ['PATH'] = str(bin_dir) + os.pathsep + os.environ.get('PATH', '')
+    os.environ['STUB_STARTUP_LATENCY'] = str(startup_latency)
+    os.environ['STUB_FILE_LATENCY'] = str(file_latency)
+    os.environ['STUB_CHATTER_LINES'] = str(chatter_lines)
+    os.environ['STUB_HANG_TIME'] = str(hang_time)
+    os.environ['STUB_LOG'] = str(stub_log_path)
+    os.environ['STUB_PID'] = str(stub_pid_path(stub_log_path))
+    return stub_log_path
+
+def stub_pid_path(stub_log_path):
+    """Returns the path of the file the stub writes its pid to."""
+    return stub_log_path.with_name(stub_pid_file_name)
+
+def kill_stub(stub_log_path, killed):
+    """Kills the running stub, if any, and sets the killed event."""
+    try:
+        pid = int(stub_pid_path(stub_log_path).read_text())
+        os.kill(pid, signal.SIGKILL)
+        killed.set()
+    except (IOError, ValueError, ProcessLookupError):
+        pass
+
+def create_batch(work_dir, size):
+    """Creates (unless it already exists) a directory of size empty photo
+    files to import and returns its path."""
+    batch_dir = work_dir / 'batch-{}'.format(size)
+    batch_dir.mkdir(parents=True, exist_ok=True)
+    for number in range(size):
+        (batch_dir / 'IMG_{:07d}.JPG'.format(number)).touch()
+    return batch_dir
+
+def measure_import(batch_dir, library_dir, work_dir, stub_log_path, kill_margin):
+    """Returns (wall_seconds, busy_seconds, imported, killed) of importing
+    batch_dir, where busy_seconds is how long the stub spent importing (None
+    if it never finished) and killed is True if the stub was still running
+    kill_margin seconds after the completion timeout and was killed."""
+    for file_path in (stub_log_path, stub_pid_path(stub_log_path)):
+        if file_path.exists():
+            file_path.unlink()
+    killed = threading.Event()
+    watchdog = threading.Timer(sync.process_wait_completion_time + kill_margin, kill_stub, (stub_log_path, killed))
+    watchdog.start()
+    start_time = time.perf_counter()
+    # import_photos() always reports how long it will wait
+    with redirect_stdout(io.StringIO()):
+        imported = sync.import_photos(batch_dir, library_dir, work_dir)
+    wall_seconds = time.perf_counter() - start_time
+    watchdog.cancel()
+
+    busy_seconds = None
+    if stub_log_path.exists():
+        with stub_log_path.open('r') as stub_log:
+            stub_run = json.loads(stub_log.readline())
+        busy_seconds = stub_run['end'] - stub_run['start']
+    return (wall_seconds, busy_seconds, imported, killed.is_set())
+
+def run_benchmark(batch_size, repeats, work_dir, library_dir, stub_log_path, kill_margin):
+    """Imports a batch of the given size repeats times, printing a line of
+    median results."""
+    batch_dir = create_batch(work_dir, batch_size)
+    runs = [measure_import(batch_dir, library_dir, work_dir, stub_log_path, kill_margin) for _ in range(repeats)]
+    wall_seconds = statistics.median(wall for (wall, busy, imported, killed) in runs)
+    busy_runs = [(wall, busy) for (wall, busy, imported, killed) in runs if busy != None]
+    busy_seconds = statistics.median(busy for (wall, busy) in busy_runs) if busy_runs else 0.0
+    overhead_seconds = statistics.median(wall - busy for (wall, busy) in busy_runs) if busy_runs else 0.0
+    # import_photos() should give up at its timeout, not wait on regardless
+    late_seconds = statistics.median(max(0.0, wall - sync.process_wait_completion_time)
+                                     for (wall, busy, imported, killed) in runs)
+    num_failures = sum(1 for (wall, busy, imported, killed) in runs if not imported)
+    num_kills = sum(1 for (wall, busy, imported, killed) in runs if killed)
+    print('{:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>12.2f} {:>6}/{} {:>6}/{}'
+          .format(batch_size, wall_seconds, busy_seconds, overhead_seconds, late_seconds,
+                  batch_size / wall_seconds, num_failures, repeats, num_kills, repeats), flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="""Benchmarks importing
+    batches of photos with import_photos() against a stub osascript,
+    reporting median wall time, the time the stub was busy importing, the
+    overhead of waiting on it beyond that, the time spent past the
+    completion timeout, throughput, the number of imports that did not
+    succeed within the timeout and the number of stubs killed.""")
+    parser.add_argument('-s', '--batch-sizes', help="""Comma separated
+    numbers of photos in each import batch. Defaults to
+    {}.""".format(default_batch_sizes), default=default_batch_sizes)
+    parser.add_argument('-w', '--work-dir', help="""Directory in which to
+    generate the stub and the batches. Defaults to
+    {}.""".format(default_work_dir), type=Path, default=default_work_dir)
+    parser.add_argument('-r', '--repeats', help="""Number of imports of
+    each batch size. Defaults to {}.""".format(default_repeats), type=int,
+    default=default_repeats)
+    parser.add_argument('--startup-latency', help="""Seconds the stub takes
+    to start importing. Defaults to {}.""".format(default_startup_latency),
+    type=float, default=default_startup_latency)
+    parser.add_argument('--file-latency', help="""Seconds the stub takes to
+    import each photo. Defaults to {}.""".format(default_file_latency),
+    type=float, default=default_file_latency)
+    parser.add_argument('--chatter-lines', help="""Lines the stub writes to
+    each of stdout and stderr per photo. Defaults to
+    {}.""".format(default_chatter_lines), type=int, default=default_chatter_lines)
+    parser.add_argument('--hang-time', help="""Seconds the stub hangs after
+    importing before it exits. Defaults to {}.""".format(default_hang_time),
+    type=float, default=default_hang_time)
+    parser.add_argument('--poll-interval', help="""Overrides
+    process_wait_sleep_time, the seconds import_photos() waits on the import
+    process each time round its polling loop. Defaults to
+    {}.""".format(sync.process_wait_sleep_time), type=float,
+    default=sync.process_wait_sleep_time)
+    parser.add_argument('--timeout', help="""Overrides
+    process_wait_completion_time, the seconds import_photos() allows for an
+    import to complete. Defaults to {}.""".format(sync.process_wait_completion_time),
+    type=float, default=sync.process_wait_completion_time)
+    parser.add_argument('--kill-margin', help="""Seconds after the timeout
+    at which a still running stub is killed. Defaults to
+    {}.""".format(default_kill_margin), type=float, default=default_kill_margin)
+    args = parser.parse_args()
+
+    sync.process_wait_sleep_time = args.poll_interval
+    sync.process_wait_completion_time = args.timeout
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+    library_dir = args.work_dir / 'Library.photoslibrary'
+    library_dir.mkdir(exist_ok=True)
+    stub_log_path = install_stub(args.work_dir, args.startup_latency, args.file_latency,
+                                 args.chatter_lines, args.hang_time)
+
+    print('{:>8} {:>10} {:>10} {:>10} {:>10} {:>12} {:>8} {:>8}'.format(
+          'batch', 'wall secs', 'busy secs', 'wait secs', 'late secs', 'photos/sec', 'failed', 'killed'), flush=True)
+    for batch_size in (int(batch_size) for batch_size in args.batch_sizes.split(',')):
+        run_benchmark(batch_size, args.repeats, args.work_dir, library_dir, stub_log_path, args.kill_margin)
+
+if __name__ == "__main__":
+    main()
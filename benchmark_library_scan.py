@@ -0,0 +1,168 @@
+"""Times scanning synthetic MacOS Photos libraries and diffing them against a
+synthetic Google Photos listing, so changes to list_library_photos_sqlite(),
+list_library_photos_filesystem() and the diff in main() can be compared on
+any platform (including Linux, without Photos or AppleScript).
+
+Libraries of each requested size are generated once in the work directory
+and reused by later runs. Each benchmark is run once untraced for wall time
+and once under tracemalloc for peak memory."""
+
+from pathlib import Path
+import argparse
+import gc
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+import google_photos_sync_mac as sync
+
+default_sizes = '10000,100000,1000000'
+default_benchmarks = 'sqlite,filesystem,diff'
+default_work_dir = Path(tempfile.gettempdir()) / 'google-photos-sync-mac-benchmark'
+default_new_fraction = 0.01
+files_per_masters_dir = 1000
+
+def photo_filename(number):
+    """Returns the filename of the numbered synthetic photo. Every tenth one
+    is a video and the case varies, as it does in real libraries."""
+    if number % 10 == 0:
+        return 'MOV_{:07d}.MOV'.format(number)
+    elif number % 3 == 0:
+        return 'img_{:07d}.jpg'.format(number)
+    else:
+        return 'IMG_{:07d}.JPG'.format(number)
+
+def create_sqlite_library(library_dir, size):
+    """Creates database/Photos.sqlite in library_dir with size rows in
+    ZADDITIONALASSETATTRIBUTES, unless it already exists."""
+    database_dir = library_dir / 'database'
+    sqlite_path = database_dir / 'Photos.sqlite'
+    if sqlite_path.is_file():
+        return
+    database_dir.mkdir(parents=True, exist_ok=True)
+    temp_sqlite_path = database_dir / 'Photos.sqlite.tmp'
+    with sqlite3.connect(str(temp_sqlite_path)) as db_conn:
+        db_conn.execute("""create table ZADDITIONALASSETATTRIBUTES (
+                           Z_PK integer primary key,
+                           ZASSET integer,
+                           ZORIGINALFILENAME varchar)""")
+        db_conn.executemany("""insert into ZADDITIONALASSETATTRIBUTES (ZASSET, ZORIGINALFILENAME)
+                               values (?, ?)""", ((number, photo_filename(number)) for number in range(size)))
+    temp_sqlite_path.rename(sqlite_path)
+
+def create_filesystem_library(library_dir, size):
+    """Creates a Masters tree of size empty photo files in library_dir, laid
+    out in dated import directories as older versions of Photos do, unless
+    it already exists."""
+    masters_dir = library_dir / 'Masters'
+    complete_marker = library_dir / '.masters-complete'
+    if complete_marker.exists():
+        return
+    for number in range(size):
+        if number % files_per_masters_dir == 0:
+            batch = number // files_per_masters_dir
+            import_dir = masters_dir / '{:04d}'.format(2000 + batch // 336) / '{:02d}'.format(batch // 28 % 12 + 1) \
+                / '{:02d}'.format(batch % 28 + 1) / '{:06d}'.format(batch)
+            import_dir.mkdir(parents=True, exist_ok=True)
+        open(os.path.join(str(import_dir), photo_filename(number)), 'w').close()
+    complete_marker.touch()
+
+def google_media_items(size, new_fraction):
+    """Generator yielding a synthetic Google listing of the size photos in the
+    library plus new_fraction as many again that are not in the library."""
+    for number in range(size + int(size * new_fraction)):
+        yield {
+            'id': 'ID{:07d}'.format(number),
+            'filename': photo_filename(number),
+            'mimeType': 'video/quicktime' if number % 10 == 0 else 'image/jpeg',
+            'baseUrl': 'https://lh3.googleusercontent.com/lr/{:07d}'.format(number),
+            'mediaMetadata': {
+                'creationTime': '2019-{:02d}-{:02d}T12:00:00Z'.format(number % 12 + 1, number % 28 + 1),
+                'width': '4032',
+                'height': '3024',
+            },
+        }
+
+def measure(function):
+    """Returns (wall_seconds, peak_bytes, result) of calling function, timed
+    without tracing and then called again under tracemalloc."""
+    gc.collect()
+    start_time = time.perf_counter()
+    result = function()
+    wall_seconds = time.perf_counter() - start_time
+    del result
+
+    gc.collect()
+    tracemalloc.start()
+    result = function()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (wall_seconds, peak_bytes, result)
+
+def run_benchmarks(library_dir, size, benchmarks, new_fraction, download_order, max_downloads):
+    """Runs the named benchmarks against the library of the given size,
+    printing a line of results for each."""
+    if 'sqlite' in benchmarks:
+        create_sqlite_library(library_dir, size)
+        (wall_seconds, peak_bytes, photos) = measure(
+            lambda: sync.list_library_photos_sqlite(library_dir))
+        print_result('sqlite', size, wall_seconds, peak_bytes, '{} photos'.format(len(photos)))
+
+    if 'filesystem' in benchmarks:
+        create_filesystem_library(library_dir, size)
+        (wall_seconds, peak_bytes, photos) = measure(
+            lambda: sync.list_library_photos_filesystem(library_dir))
+        print_result('filesystem', size, wall_seconds, peak_bytes, '{} photos'.format(len(photos)))
+
+    if 'diff' in benchmarks:
+        # Library index built outside the measurement, as main() does, and
+        # the listing too so that only the diff is measured (building the
+        # listing's dicts would otherwise dominate)
+        photo_files_on_disk = dict((photo_filename(number).lower(), True) for number in range(size))
+        media_items = list(google_media_items(size, new_fraction))
+
+        def diff():
+            selector = sync.DownloadSelector(download_order, max_downloads)
+            sync.select_photos_to_download(media_items, photo_files_on_disk, selector)
+            return selector.selected()
+        (wall_seconds, peak_bytes, photos_to_download) = measure(diff)
+        print_result('diff', size, wall_seconds, peak_bytes, '{} to download'.format(len(photos_to_download)))
+
+def print_result(benchmark, size, wall_seconds, peak_bytes, detail):
+    print('{:<12} {:>9} {:>10.3f} {:>12.1f}   {}'
+          .format(benchmark, size, wall_seconds, peak_bytes / (1024 * 1024), detail), flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="""Benchmarks scanning
+    synthetic Photos libraries and diffing them against a synthetic Google
+    Photos listing, reporting wall time and peak traced memory.""")
+    parser.add_argument('-s', '--sizes', help="""Comma separated numbers of
+    photos in each synthetic library. Defaults to {}.""".format(default_sizes),
+    default=default_sizes)
+    parser.add_argument('-b', '--benchmarks', help="""Comma separated
+    benchmarks to run from sqlite, filesystem and diff. Defaults to
+    {}.""".format(default_benchmarks), default=default_benchmarks)
+    parser.add_argument('-w', '--work-dir', help="""Directory in which to
+    generate (and keep for later runs) the synthetic libraries. Defaults to
+    {}.""".format(default_work_dir), type=Path, default=default_work_dir)
+    parser.add_argument('-n', '--new-fraction', help="""Fraction of the
+    library size listed by Google but missing from the library. Defaults to
+    {}.""".format(default_new_fraction), type=float, default=default_new_fraction)
+    parser.add_argument('-o', '--download-order', help="""Download order used
+    by the diff benchmark. Defaults to {}.""".format(sync.default_download_order),
+    choices=sync.DownloadSelector.orders, default=sync.default_download_order)
+    parser.add_argument('-m', '--max-downloads', help="""Maximum downloads
+    selected by the diff benchmark. Negative value means no limit (the
+    default).""", type=int, default=-1)
+    args = parser.parse_args()
+
+    benchmarks = args.benchmarks.split(',')
+    print('{:<12} {:>9} {:>10} {:>12}'.format('benchmark', 'size', 'wall secs', 'peak MiB'), flush=True)
+    for size in (int(size) for size in args.sizes.split(',')):
+        library_dir = args.work_dir / 'Library-{}.photoslibrary'.format(size)
+        run_benchmarks(library_dir, size, benchmarks, args.new_fraction, args.download_order, args.max_downloads)
+
+if __name__ == "__main__":
+    main()
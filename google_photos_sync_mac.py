@@ -6,15 +6,25 @@ from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth2Session
 from urllib3.util.retry import Retry
 from subprocess import Popen, TimeoutExpired, PIPE
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import applescript
 import argparse
+import calendar
+import cProfile
+import hashlib
+import heapq
+import itertools
 import json
 import os
 import shutil
+import socket
 import sqlite3
 import sys
 import tempfile
-from time import strptime, mktime, sleep, time
+import tracemalloc
+from time import localtime, strftime, strptime, mktime, perf_counter, sleep, time
 
 ## ############################################################################
 ## Default config - can be overridden by command line arguments
@@ -24,6 +34,12 @@ default_credentials_file_name = 'credentials.json'
 default_max_retries_per_request = 3
 default_mac_photos_dir = Path.home() / 'Pictures' / 'Photos Library.photoslibrary'
 default_fetch_size = 50
+default_segment_threshold = 256 # megabytes
+default_download_segments = 4
+default_download_order = 'listing'
+default_profile_top_allocations = 25
+default_download_profile = 'original'
+default_lease_time = 600 # seconds
 
 ## ############################################################################
 ## Global config
@@ -32,8 +48,41 @@ import_applescript_file_name = 'import_photos.applescript'
 list_applescript_file_name = 'list_photos.applescript'
 users_cache_dir_name = 'users'
 users_photos_dir_name = 'photos'
+users_manifests_dir_name = 'manifests'
+users_journal_file_name = 'journal.sqlite'
+users_settings_file_name = 'settings.json'
+users_queue_file_name = 'queue.sqlite'
+queue_max_attempts = 3
+queue_claim_size = 10
+worker_client_secret_env_var = 'GOOGLE_PHOTOS_SYNC_CLIENT_SECRET'
+import_verify_attempts = 6
+import_retry_attempts = 2
+import_max_attempts = 3
+users_retry_dir_name = 'retry'
+users_import_dir_name = 'import'
+users_failed_dir_name = 'failed'
+profiles_dir_name = 'profiles'
+plan_format_version = 1
+plan_photo_fields = ['id', 'filename', 'mimeType', 'width', 'height', 'creationTime']
+manifests_to_keep = 10
+download_hash_algorithm = 'sha256'
 process_wait_sleep_time = 5 # seconds
 process_wait_completion_time = 600 # seconds
+batch_get_max_ids = 50
+albums_page_size = 50
+media_type_filters = {'photo': 'PHOTO', 'video': 'VIDEO'}
+media_type_mime_prefixes = {'photo': 'image', 'video': 'video'}
+
+# Dict of profile_name: settings. A max_dimension (pixels) downloads larger
+# images scaled to fit within that width and height; max_video_size
+# (megabytes) skips larger videos. None means no limit.
+download_profiles = OrderedDict([
+    ('original', {'max_dimension': None, 'max_video_size': None}),
+    ('fast', {'max_dimension': 2048, 'max_video_size': 100}),
+])
+download_chunk_size = 128 # bytes
+segment_chunk_size = 1024 * 1024 # bytes
+staging_free_space_margin = 1024 * 1024 * 1024 # bytes
 
 authorization_base_url = "https://accounts.google.com/o/oauth2/v2/auth"
 scopes = ['https://www.googleapis.com/auth/photoslibrary.readonly']
@@ -55,27 +104,74 @@ def main():
        * Tidy up cache dirs and wait for any still running sub-processes"""
     args = parse_arguments()
     
-    if args.verbose:
-        print('Inspecting photos library: {}'.format(args.mac_photos_library), flush=True)
-
-    # dict of filename: full_file_path
-    photo_files_on_disk = list_library_photos(args.mac_photos_library, args.verbose, args.case_sensitive)
+    if args.worker:
+        run_worker(args)
+        return
     
-    if photo_files_on_disk == None or len(photo_files_on_disk) == 0:
-        error_print("Could not get list of photo filenames from MasOS Photos app")
+    if args.profile:
+        profiler = PhaseProfiler(args.cache_dir / profiles_dir_name / strftime('%Y%m%d-%H%M%S'),
+                                 args.profile_top_allocations)
+    else:
+        profiler = PhaseProfiler()
     
-    for nickname in get_users(args):
+    # Executing a plan inspects the libraries too, to skip photos imported
+    # since planning (cheaply if they are SQLite-based and indexed before)
+    libraries = []
+    for photos_library in args.mac_photos_libraries:
+        if args.verbose:
+            print('Inspecting photos library: {}'.format(photos_library), flush=True)
+        
+        # dict of filename: full_file_path
+        library_index = LibraryIndex(photos_library, args.cache_dir, args.case_sensitive)
+        with profiler.phase('library-scan'):
+            photos = list_library_photos(photos_library, args.verbose, args.case_sensitive, library_index)
+        if library_index.photos == None:
+            # Not an SQLite library - imports cannot be verified
+            library_index = None
+        
+        if photos == None or len(photos) == 0:
+            error_print("Could not get list of photo filenames from MasOS Photos app")
+        libraries.append(PhotosLibrary(photos_library, photos, library_index, args.case_sensitive))
+    
+    if args.execute_plan != None:
+        # The plan says what to download
+        plan = load_plan(args.execute_plan)
+        users = [nickname for nickname in get_users(args) if nickname in plan['users']]
+    else:
+        # A photo needs downloading if any of the libraries is missing it
+        if len(libraries) == 1:
+            photo_files_on_disk = libraries[0].photos
+        else:
+            photo_files_on_disk = dict.fromkeys(set(libraries[0].photos).intersection(
+                *(library.photos for library in libraries[1:])), True)
         
+        plan = {'version': plan_format_version, 'created': time(), 'url_source': 'mediaItems:batchGet',
+                'photo_fields': plan_photo_fields, 'users': OrderedDict()}
+        users = get_users(args)
+
+    if not args.dry_run and (args.execute_plan != None or args.upgrade_originals):
+        # Either would start a new run, so must not silently resume (or
+        # abandon) an interrupted one
+        for nickname in users:
+            if RunJournal(get_user_cache_dir(args, nickname)).is_resumable():
+                error_print("User {} has an interrupted run - finish it by running without --execute-plan and "
+                            "--upgrade-originals first".format(nickname))
+
+    for nickname in users:
+
         if args.verbose:
             print('Processing user {}'.format(nickname), flush=True)
         
         user_cache_dir = get_user_cache_dir(args, nickname)
         user_photos_dir = user_cache_dir / users_photos_dir_name
         
-        # empty the user's photos cache dir
-        if user_photos_dir.exists():
+        # Resume an interrupted run, otherwise empty the user's photos cache
+        # dir. Dry runs and planning must leave an interrupted run intact.
+        journal = RunJournal(user_cache_dir)
+        resuming = not args.dry_run and journal.is_resumable()
+        if not resuming and not args.dry_run and user_photos_dir.exists():
             shutil.rmtree(user_photos_dir)
-        user_photos_dir.mkdir()
+        user_photos_dir.mkdir(exist_ok=True)
     
         token_persister = TokenPersister(user_cache_dir)
         session = create_session(nickname, args, token_persister)
@@ -86,96 +182,176 @@ def main():
                       .format(nickname), flush=True)
             continue
         
-        # Dict of filename: photo_metadata_dict
-        photos = dict()
+        download_profile = get_download_profile(args, user_cache_dir)
         
-        # The token should exist now
-        token = token_persister.load_token()
-        
-        # Get the first batch of photos-metadata and populate photos dict
-        if args.verbose:
-            print("Fetching list of photos from Google...", flush=True)
-        response = session.get('https://photoslibrary.googleapis.com/v1/mediaItems',
-                               headers={'Authorization': 'Bearer '+token['access_token']})
-        next_page_token = parse_get_mediaitems_response(response, photos)
+        if resuming:
+            # Listing and diff already done - carry on with what is left
+            if args.verbose:
+                print("Resuming interrupted run for user {}".format(nickname), flush=True)
+            photos_to_download = journal.planned_photos()
+            downloaded_records = journal.downloaded_records()
+            download_profile = journal.run_settings().get('download_profile', download_profile)
+            with profiler.phase('listing'):
+                refresh_base_urls(session, token_persister,
+                                  [photo_metadata for filename, photo_metadata in photos_to_download.items()
+                                   if filename not in downloaded_records], args.verbose)
+        elif args.execute_plan != None:
+            # Listing and diff done when the plan was made
+            user_plan = plan['users'][nickname]
+            download_profile = user_plan['download_profile']
+            if args.verbose:
+                print("Executing plan made {} for user {}".format(strftime('%Y-%m-%d %H:%M:%S',
+                      localtime(plan['created'])), nickname), flush=True)
+            with profiler.phase('listing'):
+                # Google's current metadata, in the planned order
+                planned_ids = [planned_photo[0] for planned_photo in user_plan['photos']]
+                media_items = dict((photo_metadata['id'], photo_metadata) for photo_metadata in
+                                   get_media_items(session, token_persister, planned_ids, args.verbose))
+                # Skipping any imported into every library since planning
+                photos_to_download = OrderedDict(
+                    (media_items[media_item_id]['filename'], media_items[media_item_id])
+                    for media_item_id in planned_ids if media_item_id in media_items and
+                    not all(library.contains(media_items[media_item_id]['filename']) for library in libraries))
+            downloaded_records = dict()
+            if not args.dry_run:
+                journal.start_run(photos_to_download, {'download_profile': download_profile})
+        elif args.upgrade_originals:
+            # Re-download originals of photos previously downloaded reduced
+            download_profile = download_profiles['original']
+            with profiler.phase('listing'):
+                photos_to_download = OrderedDict(
+                    (photo_metadata['filename'], photo_metadata) for photo_metadata in
+                    get_media_items(session, token_persister, journal.reduced_photo_ids(), args.verbose))
+            downloaded_records = dict()
+            if not args.dry_run:
+                journal.start_run(photos_to_download, {'download_profile': download_profile,
+                                                       'upgrade_originals': True})
+        else:
+            # Compare filenames from Google and filesystem as they are listed,
+            # keeping only those selected for download
+            if args.verbose:
+                print("Fetching list of photos from Google...", flush=True)
+            selector = DownloadSelector(args.download_order, args.max_downloads)
+            with profiler.phase('listing'):
+                if args.albums:
+                    media_items = itertools.chain.from_iterable(
+                        list_google_media_items(session, token_persister, args.verbose, album_id, args.media_type,
+                                                args.fetch_size)
+                        for album_id in find_album_ids(session, token_persister, args.albums, args.verbose))
+                else:
+                    media_items = list_google_media_items(session, token_persister, args.verbose,
+                                                          media_type=args.media_type, fetch_size=args.fetch_size)
+                num_photos = select_photos_to_download(media_items, photo_files_on_disk, selector,
+                                                       args.case_sensitive, profiler)
+            if args.verbose:
+                print(num_photos,'photos inspected in Google Photos online', flush=True)
         
-        # Repeat whilst Google returns a token indicating more items to come
-        while next_page_token != None:
-            if args.verbose >= 3:
-                print('Got {} photos. Fetching next page with token "..{}".'
-                      .format(len(photos), next_page_token[-27:]), flush=True)
-            elif args.verbose >= 2:
-                print('Got {} photos.'.format(len(photos)), flush=True)
-                
-            response = session.get('https://photoslibrary.googleapis.com/v1/mediaItems',
-                               headers={'Authorization': 'Bearer '+token['access_token']},
-                               params={'pageToken': next_page_token})
-            next_page_token = parse_get_mediaitems_response(response, photos)
-        if args.verbose:
-            print (len(photos),'photos found in Google Photos online')
-            
-        # Compare filenames from Google and filesystem.
-        # Create dict of filename: photo_metadata_dict
-        photos_to_download = dict()
-        for filename in photos:
-            if args.case_sensitive:
-                need_to_download = filename not in photo_files_on_disk
-            else:
-                need_to_download = filename.lower() not in photo_files_on_disk
-                
-            if need_to_download:
-                photos_to_download[filename] = photos[filename]
-            
-            if args.max_downloads > 0:
-                # We have a maximum number allowed to download
-                if len(photos_to_download) >= args.max_downloads:
-                    break
+            # Dict of filename: photo_metadata_dict, in download order
+            photos_to_download = selector.selected()
         
+            downloaded_records = dict()
+            if not args.dry_run:
+                journal.start_run(photos_to_download, {'download_profile': download_profile})
+
         if args.verbose:
             print(len(photos_to_download),'photos need to be downloaded from Google', flush=True)
         
         if not args.dry_run:
-            # Download each photo from Google
+            # Download each photo from Google, recording each in a manifest
+            manifest = DownloadManifest.for_new_run(user_cache_dir)
+            if args.staging_budget != None:
+                staging_budget = StagingBudget(user_photos_dir, args.staging_budget * 1024 * 1024)
+            else:
+                staging_budget = None
             num_successful_downloads = 0
-            for filename, photo_metadata in photos_to_download.items():
-                # Work out download url
-                mime_type = photo_metadata['mimeType']
-                if mime_type.startswith('image'):
-                    url_suffix = '=d'
-                elif mime_type.startswith('video'):
-                    url_suffix = '=dv'
+            # Set False if an import (under the staging budget) is not confirmed
+            imported = True
+            for record in downloaded_records.values():
+                manifest.add(record)
+                if staging_budget != None:
+                    staging_budget.add(record['size'])
+            with profiler.phase('download'):
+                if args.workers > 0:
+                    # Shard the downloads across worker processes
+                    num_successful_downloads += download_with_workers(nickname, photos_to_download, downloaded_records,
+                                                                      manifest, journal, args)
                 else:
-                    if args.verbose:
-                        print("Skipping download of unknown media type {}: {}"
-                              .format(mime_type, filename))
-                    continue
-                url = photo_metadata['baseUrl']+url_suffix
+                    for filename, photo_metadata in photos_to_download.items():
+                        if filename in downloaded_records and (user_photos_dir / filename).exists():
+                            # Downloaded before the run was interrupted
+                            num_successful_downloads += 1
+                            continue
                 
-                try:
-                    file_creation_date = photo_metadata['mediaMetadata']['creationTime']
-                except:
-                    file_creation_date = None
+                        # Work out download url
+                        (url, reduced, download_size) = get_download_url(session, photo_metadata, download_profile,
+                                                                         staging_budget != None)
+                        if url == None:
+                            if args.verbose:
+                                print("Skipping download of {}: {}".format(filename, reduced), flush=True)
+                            continue
                 
-                if download_file(session, url, filename, user_photos_dir, file_creation_date, args.verbose):
-                    num_successful_downloads += 1
+                        try:
+                            file_creation_date = photo_metadata['mediaMetadata']['creationTime']
+                        except:
+                            file_creation_date = None
+                
+                        if staging_budget != None:
+                            # Import and purge what is staged so far if this file
+                            # would take us over budget, or might as its size is
+                            # unknown (its actual size counts once downloaded)
+                            if (download_size == None or not staging_budget.fits(download_size)) \
+                               and staging_budget.staged_bytes > 0:
+                                if args.verbose:
+                                    print("Staging budget reached with {} bytes staged - importing before downloading more"
+                                          .format(staging_budget.staged_bytes), flush=True)
+                                with profiler.phase('import'):
+                                    imported = import_staged_photos(user_photos_dir, manifest, journal, nickname,
+                                                                    args, libraries)
+                                if not imported:
+                                    print("Stopping downloads for user {} - import not confirmed so staged photos cannot be purged"
+                                          " (they will be imported again when the run is resumed)"
+                                          .format(nickname), flush=True)
+                                    break
+                                staging_budget.purge()
+                            if download_size != None and not staging_budget.fits(download_size, ignore_budget=True):
+                                print("Skipping {} - {} bytes will not fit in free disk space"
+                                      .format(filename, download_size), flush=True)
+                                continue
+                
+                        download_record = download_file(session, url, filename, user_photos_dir, file_creation_date,
+                                                        args.verbose, args.segment_threshold * 1024 * 1024,
+                                                        args.download_segments)
+                        if download_record:
+                            download_record['id'] = photo_metadata.get('id')
+                            download_record['reduced'] = reduced
+                            manifest.add(download_record)
+                            journal.mark_downloaded(download_record)
+                            num_successful_downloads += 1
+                            if staging_budget != None:
+                                staging_budget.add(download_record['size'])
             
             if args.verbose:
                 print("{} of {} photos successfully downloaded".format(num_successful_downloads, len(photos_to_download)), flush=True)
-        
-            # Import photos for this user
-            if num_successful_downloads > 0:
-                if args.verbose:
-                    print('Importing photos for user {}'.format(nickname), flush=True)
-                    
-                user_cache_dir = get_user_cache_dir(args, nickname)
-                user_photos_dir = user_cache_dir / users_photos_dir_name
-    
-                import_photos(user_photos_dir, args.mac_photos_library, args.cache_dir, args.verbose)
-    
+            
+            # Import (remaining) photos for this user, unless an import has
+            # just failed - importing the same photos again straight away
+            # could duplicate any that Photos is still slow to record
+            if imported:
+                with profiler.phase('import'):
+                    imported = import_staged_photos(user_photos_dir, manifest, journal, nickname, args, libraries)
+            if imported:
+                journal.finish_run()
             else:
-                if args.verbose:
-                    print('Skiping import for user {} - no photos to import'.format(nickname), flush=True)
+                # Leave the run resumable so the next run retries importing
+                # the staged photos rather than deleting and re-downloading them
+                print("Run for user {} will be resumed next time to retry the import".format(nickname), flush=True)
 
+        elif args.plan_out != None:
+            # Planning - record what to download for later execution
+            plan['users'][nickname] = {
+                'download_profile': download_profile,
+                'photos': [plan_photo(photo_metadata) for photo_metadata in photos_to_download.values()],
+            }
         else:
             # Dry run - just print out files to download
             for filename, photo_metadata in photos_to_download.items():
@@ -184,26 +360,42 @@ def main():
     
     # End of looping through users to download / import
     
-    if not args.dry_run:
-        # Loop through each user deleting photos
+    if args.plan_out != None:
+        write_plan(args.plan_out, plan)
+        if args.verbose:
+            print("Plan for {} photos written to {}".format(
+                sum(len(user_plan['photos']) for user_plan in plan['users'].values()), args.plan_out), flush=True)
     
-        if len(photos_to_download) > 0:
-            if not args.keep_downloads:
-                if args.verbose:
-                    print("Deleting downloaded and imported photos...", flush=True)
+    if not args.dry_run:
+        # Loop through each user deleting photos whose import was confirmed
+        if not args.keep_downloads:
+            if args.verbose:
+                print("Deleting downloaded and imported photos...", flush=True)
+            for nickname in get_users(args):
+                user_cache_dir = get_user_cache_dir(args, nickname)
+                user_photos_dir = user_cache_dir / users_photos_dir_name
+                if not user_photos_dir.is_dir():
+                    continue
+                for filename in RunJournal(user_cache_dir).imported_filenames():
+                    imported_file_path = user_photos_dir / filename
+                    if imported_file_path.exists():
+                        imported_file_path.unlink()
+                num_remaining = sum(1 for _ in user_photos_dir.iterdir())
+                if num_remaining > 0:
+                    print("{} photos not confirmed as imported have been kept for the next run in {}"
+                          .format(num_remaining, user_photos_dir), flush=True)
+        else:
+            if args.verbose:
+                print("Downloaded photos have been kept in:", flush=True)
                 for nickname in get_users(args):
                     user_cache_dir = get_user_cache_dir(args, nickname)
                     user_photos_dir = user_cache_dir / users_photos_dir_name
-                    shutil.rmtree(user_photos_dir)
-            else:
-                if args.verbose:
-                    print("Downloaded photos have been kept in:", flush=True)
-                    for nickname in get_users(args):
-                        user_cache_dir = get_user_cache_dir(args, nickname)
-                        user_photos_dir = user_cache_dir / users_photos_dir_name
-                        print("   {}".format(user_photos_dir), flush=True)
+                    print("   {}".format(user_photos_dir), flush=True)
 
+    profiler.save()
     if args.verbose:
+        if args.profile:
+            print("Profiles written to {}".format(profiler.profile_dir), flush=True)
         print("Done", flush=True)
 
 ## ############################################################################
@@ -256,6 +448,673 @@ class TokenPersister:
                 return None
         return self._token
 
+class DownloadManifest:
+    """Records each file downloaded during a run (media item id, filename,
+    size, hash and timings) as one JSON object per line in a user-specific
+    manifest file. Each record is appended as soon as its download completes
+    so the manifest survives a crash part way through a run. The import step
+    uses it to cheaply detect missing, truncated or stray files without
+    re-reading downloads."""
+
+    def __init__(self, manifest_file_path):
+        """Creates a manifest backed by the given file. Any records already in
+        the file are loaded."""
+        self._manifest_file_path = Path(manifest_file_path)
+        # Dict of filename: record
+        self._records = dict()
+        self.load()
+
+    @classmethod
+    def for_new_run(cls, user_cache_dir):
+        """Returns an empty manifest for a run starting now, stored in the
+        user-specific cache directory. Manifests from older runs beyond the
+        most recent manifests_to_keep are deleted."""
+        manifests_dir = Path(user_cache_dir) / users_manifests_dir_name
+        manifests_dir.mkdir(exist_ok=True)
+        for old_manifest in sorted(manifests_dir.glob('manifest-*.jsonl'))[:-manifests_to_keep or None]:
+            old_manifest.unlink()
+        return cls(manifests_dir / 'manifest-{}.jsonl'.format(strftime('%Y%m%d-%H%M%S')))
+
+    @property
+    def records(self):
+        """Dict of filename: record of all downloads in this manifest."""
+        return self._records
+
+    @property
+    def manifest_file_path(self):
+        return self._manifest_file_path
+
+    def load(self):
+        """(Re)loads records from the manifest file, ignoring any badly
+        formatted line (e.g. one partly written when the program crashed)."""
+        self._records = dict()
+        try:
+            with self._manifest_file_path.open('r') as manifest_stream:
+                for line in manifest_stream:
+                    try:
+                        record = json.loads(line)
+                        self._records[record['filename']] = record
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        print('Ignoring bad line in manifest file:', self._manifest_file_path, flush=True)
+        except FileNotFoundError:
+            pass
+
+    def add(self, record):
+        """Adds the download record (as returned by download_file()) to this
+        manifest and appends it to the manifest file."""
+        self._records[record['filename']] = record
+        with self._manifest_file_path.open('a') as manifest_stream:
+            manifest_stream.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def verify(self, directory, full=False, verbose=False):
+        """Checks the files in directory against this manifest. Returns a list
+        of paths of files that should not be imported: files not in the
+        manifest and files whose size differs from the manifest. If full is
+        True the hash of each file is also recomputed and compared (this reads
+        every file). Manifest entries with no file in directory are reported
+        in verbose output only."""
+        directory = Path(directory)
+        bad_files = []
+        for file_path in directory.iterdir():
+            record = self._records.get(file_path.name)
+            if record == None:
+                reason = 'not in manifest'
+            elif file_path.stat().st_size != record['size']:
+                reason = 'expected {} bytes but is {}'.format(record['size'], file_path.stat().st_size)
+            elif full and hash_file(file_path, record['hash_algorithm']) != record['hash']:
+                reason = 'hash mismatch'
+            else:
+                continue
+            if verbose:
+                print("Bad download {}: {}".format(file_path.name, reason), flush=True)
+            bad_files.append(file_path)
+
+        if verbose >= 2:
+            for filename in self._records:
+                if not (directory / filename).exists():
+                    print("Downloaded file {} is missing".format(filename), flush=True)
+
+        return bad_files
+
+class DownloadSelector:
+    """Selects which of the media items missing from the Photos library to
+    download, and in what order, according to a download order policy:
+       * listing - the order Google lists them (the default)
+       * newest - most recent creationTime first
+       * smallest - fewest pixels first, all photos before any video (Google
+         does not report file sizes when listing)
+       * photos-first - photos before videos, otherwise in listing order
+    Items are offered one at a time as they are listed. With a limit only the
+    best limit items so far are held, in a bounded heap, so neither the
+    listing nor the candidates need ever be held or sorted in full. If the
+    same filename is offered more than once, the last one offered wins."""
+
+    orders = ('listing', 'newest', 'smallest', 'photos-first')
+
+    def __init__(self, order=default_download_order, limit=-1):
+        """Creates a selector for the given order policy (see orders) keeping
+        at most limit items. A limit of zero or less means no limit."""
+        if order not in self.orders:
+            raise ValueError("Unknown download order: {}".format(order))
+        self._order = order
+        self._limit = limit
+        # Heap of [negated_priority, filename, media_item, valid] lists. Lower
+        # priorities are more valuable so, negated, the least valuable item
+        # kept is at the root ready to be evicted.
+        self._heap = []
+        # Dict of filename: heap entry for all valid entries in the heap
+        self._entries = dict()
+        self._sequence = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def is_final(self):
+        """True if no further offered item could be selected, i.e. there is
+        a limit, it has been reached and items are taken in listing order."""
+        return self._order == 'listing' and 0 < self._limit <= len(self._entries)
+
+    def priority(self, media_item, sequence):
+        """Returns a tuple of numbers for the media item (which was the
+        sequence'th offered); lower values are downloaded first."""
+        is_video = int(media_item.get('mimeType', '').startswith('video'))
+        if self._order == 'newest':
+            creation_secs = parse_creation_time(media_item)
+            return (-creation_secs if creation_secs != None else float('inf'), sequence)
+        elif self._order == 'smallest':
+            try:
+                metadata = media_item['mediaMetadata']
+                pixels = int(metadata['width']) * int(metadata['height'])
+            except (KeyError, ValueError):
+                pixels = float('inf')
+            return (is_video, pixels, sequence)
+        elif self._order == 'photos-first':
+            return (is_video, sequence)
+        else:
+            return (sequence,)
+
+    def offer(self, filename, media_item):
+        """Considers the media item for download, evicting the least valuable
+        item currently selected if the limit has been reached."""
+        self._sequence += 1
+        negated_priority = tuple(-value for value in self.priority(media_item, self._sequence))
+        entry = [negated_priority, filename, media_item, True]
+
+        replaced_entry = self._entries.pop(filename, None)
+        if replaced_entry != None:
+            # Lazily removed from the heap when it reaches the root
+            replaced_entry[3] = False
+
+        if 0 < self._limit <= len(self._entries):
+            self._discard_invalid_root()
+            if negated_priority <= self._heap[0][0]:
+                # Less valuable than everything already selected
+                return
+            evicted_entry = heapq.heapreplace(self._heap, entry)
+            del self._entries[evicted_entry[1]]
+        else:
+            heapq.heappush(self._heap, entry)
+        self._entries[filename] = entry
+
+    def selected(self):
+        """Returns an OrderedDict of filename: media_item for the selected
+        items, most valuable first."""
+        entries = sorted(self._entries.values(), key=lambda entry: entry[0], reverse=True)
+        return OrderedDict((entry[1], entry[2]) for entry in entries)
+
+    def _discard_invalid_root(self):
+        while self._heap and not self._heap[0][3]:
+            heapq.heappop(self._heap)
+
+class StagingBudget:
+    """Caps the bytes of downloaded-but-not-yet-imported files held in a
+    staging directory, so that a sync of any size runs in a bounded amount
+    of disk space. Downloads are staged until the next one would exceed the
+    budget (or the free space on the disk, less a safety margin) at which
+    point the caller should import and then purge() the staged files."""
+
+    def __init__(self, staging_dir, budget_bytes, free_space_margin=staging_free_space_margin):
+        """Creates a budget of budget_bytes for the given staging directory.
+        free_space_margin bytes of disk space are always left free."""
+        self._staging_dir = Path(staging_dir)
+        self._budget_bytes = budget_bytes
+        self._free_space_margin = free_space_margin
+        self.staged_bytes = 0
+
+    def fits(self, size, ignore_budget=False):
+        """Returns True if a download of size bytes can be
+        staged now without exceeding the budget or the free disk space. If
+        ignore_budget is True only the free disk space is checked."""
+        free_bytes = shutil.disk_usage(str(self._staging_dir)).free - self._free_space_margin
+        if size > free_bytes:
+            return False
+        return ignore_budget or self.staged_bytes + size <= self._budget_bytes
+
+    def add(self, size):
+        """Records that size more bytes have been staged."""
+        self.staged_bytes += size
+
+    def purge(self):
+        """Deletes all staged files (which must have been imported)."""
+        for file_path in self._staging_dir.iterdir():
+            file_path.unlink()
+        self.staged_bytes = 0
+
+class RunJournal:
+    """Records, in a user-specific SQLite database, the photos planned for
+    download in the current run and each photo's progress through the states
+    planned -> downloaded -> imported (or failed, if its import could not be
+    confirmed after import_max_attempts). Every state transition is committed
+    immediately so that a run interrupted by a crash or reboot can be resumed
+    without listing, downloading or importing again, and so that only photos
+    whose import was confirmed are ever deleted."""
+
+    def __init__(self, user_cache_dir, journal_file_name=users_journal_file_name):
+        """Opens (creating if necessary) the journal in the given directory."""
+        self._db_conn = sqlite3.connect(str(Path(user_cache_dir) / journal_file_name))
+        with self._db_conn:
+            self._db_conn.execute("""create table if not exists run (
+                                     id integer primary key check (id = 1),
+                                     started real, finished real)""")
+            self._db_conn.execute("""create table if not exists photos (
+                                     position integer primary key,
+                                     filename text unique not null,
+                                     state text not null,
+                                     metadata text not null,
+                                     record text,
+                                     updated real,
+                                     import_attempts integer not null default 0)""")
+            if 'import_attempts' not in [column[1] for column in
+                                         self._db_conn.execute("pragma table_info(photos)")]:
+                # Journal created before import attempts were counted
+                self._db_conn.execute("alter table photos add column import_attempts integer not null default 0")
+            self._db_conn.execute("""create table if not exists run_settings (
+                                     name text primary key,
+                                     value text not null)""")
+            # Not part of any one run - kept until upgraded to originals
+            self._db_conn.execute("""create table if not exists reduced_photos (
+                                     id text primary key,
+                                     filename text not null)""")
+
+    def is_resumable(self):
+        """Returns True if a run was started (i.e. its listing and diff were
+        completed) but did not finish."""
+        row = self._db_conn.execute("select finished from run").fetchone()
+        return row != None and row[0] == None
+
+    def start_run(self, photos_to_download, settings=None):
+        """Forgets any previous run and records the start of a new one which
+        will download the photos in photos_to_download (a dict of filename:
+        photo_metadata_dict) in the dict's order. settings is a dict of any
+        JSON serialisable settings a resumed run must reuse."""
+        now = time()
+        with self._db_conn:
+            self._db_conn.execute("delete from photos")
+            self._db_conn.execute("delete from run_settings")
+            self._db_conn.executemany("insert into run_settings (name, value) values (?, ?)",
+                                      ((name, json.dumps(value)) for name, value in (settings or dict()).items()))
+            self._db_conn.execute("insert or replace into run (id, started, finished) values (1, ?, null)", (now,))
+            self._db_conn.executemany("insert into photos (filename, state, metadata, updated) values (?, 'planned', ?, ?)",
+                                      ((filename, json.dumps(photo_metadata), now)
+                                       for filename, photo_metadata in photos_to_download.items()))
+
+    def run_settings(self):
+        """Returns the dict of settings given when the current run started."""
+        return dict((name, json.loads(value)) for (name, value) in
+                    self._db_conn.execute("select name, value from run_settings"))
+
+    def reduced_photo_ids(self):
+        """Returns a list of the media item ids of photos imported as reduced
+        copies rather than originals."""
+        return [row[0] for row in self._db_conn.execute("select id from reduced_photos")]
+
+    def update_reduced_photos(self, download_records):
+        """Records which of the imported photos described by download_records
+        (as returned by download_file()) were reduced copies, and forgets any
+        reduced copy now imported as an original."""
+        with self._db_conn:
+            for download_record in download_records:
+                if download_record.get('id') == None:
+                    continue
+                if download_record.get('reduced'):
+                    self._db_conn.execute("insert or replace into reduced_photos (id, filename) values (?, ?)",
+                                          (download_record['id'], download_record['filename']))
+                else:
+                    self._db_conn.execute("delete from reduced_photos where id = ?", (download_record['id'],))
+
+    def finish_run(self):
+        """Records that the current run completed."""
+        with self._db_conn:
+            self._db_conn.execute("update run set finished = ?", (time(),))
+
+    def planned_photos(self):
+        """Returns an OrderedDict of filename: photo_metadata_dict of the
+        photos in the current run that have not yet been imported (or failed)."""
+        return OrderedDict((filename, json.loads(metadata)) for (filename, metadata) in self._db_conn.execute(
+            "select filename, metadata from photos where state not in ('imported', 'failed') order by position"))
+
+    def downloaded_records(self):
+        """Returns a dict of filename: download_record of the photos in the
+        current run downloaded but not yet imported."""
+        return dict((filename, json.loads(record)) for (filename, record) in self._db_conn.execute(
+            "select filename, record from photos where state = 'downloaded'"))
+
+    def imported_filenames(self):
+        """Returns a list of filenames whose import has been confirmed."""
+        return [row[0] for row in self._db_conn.execute("select filename from photos where state = 'imported'")]
+
+    def mark_downloaded(self, download_record):
+        """Records that the photo described by the download record (as
+        returned by download_file()) has been downloaded."""
+        with self._db_conn:
+            self._db_conn.execute("update photos set state = 'downloaded', record = ?, updated = ? where filename = ?",
+                                  (json.dumps(download_record), time(), download_record['filename']))
+
+    def record_failed_imports(self, filenames, max_attempts=import_max_attempts):
+        """Counts an unconfirmed import of each of the photos with the given
+        filenames, marking those imported max_attempts times without
+        confirmation as failed. Returns a list of the filenames newly marked
+        failed."""
+        now = time()
+        with self._db_conn:
+            self._db_conn.executemany("""update photos set import_attempts = import_attempts + 1, updated = ?
+                                         where filename = ?""", ((now, filename) for filename in filenames))
+            failed_filenames = []
+            for filename in filenames:
+                row = self._db_conn.execute("select import_attempts from photos where filename = ?",
+                                            (filename,)).fetchone()
+                if row != None and row[0] >= max_attempts:
+                    failed_filenames.append(filename)
+            self._db_conn.executemany("update photos set state = 'failed' where filename = ?",
+                                      ((filename,) for filename in failed_filenames))
+        return failed_filenames
+
+    def mark_imported(self, filenames):
+        """Records that the photos with the given filenames were imported."""
+        now = time()
+        with self._db_conn:
+            self._db_conn.executemany("update photos set state = 'imported', updated = ? where filename = ?",
+                                      ((now, filename) for filename in filenames))
+
+class PhaseProfiler:
+    """Profiles named phases of a run (library scan, Google listing, diff,
+    download, import) for offline analysis. Each phase gets its own cProfile
+    profile, accumulated over every time the phase is entered, and the peak
+    traced memory whilst it was active. Phases may be nested, in which case
+    the outer phase's profile is suspended whilst the inner one runs. Unless
+    entered with snapshot=False, the top allocations made during each phase
+    are also reported (taking snapshots is expensive so should be avoided for
+    phases entered many times). Code too fine-grained to profile as a phase
+    can instead be timed by the caller and recorded with add_time(). A
+    profiler created without a profile_dir does nothing."""
+
+    def __init__(self, profile_dir=None, top_allocations=default_profile_top_allocations):
+        """Creates a profiler writing its reports to profile_dir (which is
+        created if necessary) or a disabled profiler if profile_dir is None.
+        Only the top_allocations largest allocations are reported."""
+        self.profile_dir = profile_dir
+        self._top_allocations = top_allocations
+        # Dicts of phase_name: cProfile.Profile / seconds / bytes
+        self._profiles = dict()
+        self._wall_times = OrderedDict()
+        self._peak_memory = dict()
+        # Stack of names of the phases currently active
+        self._active_phases = []
+        if self.profile_dir != None:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+            tracemalloc.start()
+
+    @contextmanager
+    def phase(self, name, snapshot=True):
+        """Context manager profiling the enclosed code as phase name."""
+        if self.profile_dir == None:
+            yield
+            return
+
+        if self._active_phases:
+            self._profiles[self._active_phases[-1]].disable()
+            self._record_peak_memory(self._active_phases[-1])
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        start_snapshot = tracemalloc.take_snapshot() if snapshot else None
+        if name not in self._profiles:
+            self._profiles[name] = cProfile.Profile()
+            self._wall_times.setdefault(name, 0)
+        profile = self._profiles[name]
+        self._active_phases.append(name)
+        start_time = time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._wall_times[name] += time() - start_time
+            self._record_peak_memory(name)
+            if start_snapshot != None:
+                self._write_allocations(name, start_snapshot, tracemalloc.take_snapshot())
+            self._active_phases.pop()
+            if self._active_phases:
+                self._profiles[self._active_phases[-1]].enable()
+
+    def add_time(self, name, seconds):
+        """Records seconds of wall time spent in phase name, timed by the
+        caller. Its functions are profiled as part of the enclosing phase."""
+        if self.profile_dir == None:
+            return
+        self._wall_times[name] = self._wall_times.get(name, 0) + seconds
+
+    def save(self):
+        """Writes each phase's profile (loadable with pstats) and a summary of
+        wall time and peak memory per phase to the profile directory."""
+        if self.profile_dir == None:
+            return
+        with (self.profile_dir / 'summary.txt').open('w') as summary_stream:
+            summary_stream.write('{:<15} {:>12} {:>16}\n'.format('phase', 'wall secs', 'peak traced KiB'))
+            for name, wall_time in self._wall_times.items():
+                if name in self._profiles:
+                    self._profiles[name].dump_stats(str(self.profile_dir / '{}.prof'.format(name)))
+                    summary_stream.write('{:<15} {:>12.3f} {:>16.1f}\n'
+                                         .format(name, wall_time, self._peak_memory[name] / 1024))
+                else:
+                    summary_stream.write('{:<15} {:>12.3f} {:>16}\n'.format(name, wall_time, '-'))
+            summary_stream.write('\nWall times include any nested phases. Phases without a peak were only\n'
+                                 'timed; their functions are profiled in the enclosing phase.\n')
+
+    def _record_peak_memory(self, name):
+        peak = tracemalloc.get_traced_memory()[1]
+        self._peak_memory[name] = max(self._peak_memory.get(name, 0), peak)
+
+    def _write_allocations(self, name, start_snapshot, end_snapshot):
+        """Appends the top allocations between the two snapshots to the
+        phase's allocations report."""
+        trace_filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+                         tracemalloc.Filter(False, cProfile.__file__)]
+        statistics = end_snapshot.filter_traces(trace_filters).compare_to(
+            start_snapshot.filter_traces(trace_filters), 'lineno')
+        with (self.profile_dir / '{}-allocations.txt'.format(name)).open('a') as allocations_stream:
+            allocations_stream.write('Top {} allocations in phase {} ending {}\n'
+                                     .format(self._top_allocations, name, strftime('%H:%M:%S')))
+            for statistic in statistics[:self._top_allocations]:
+                allocations_stream.write('   {}\n'.format(statistic))
+            allocations_stream.write('\n')
+
+class WorkQueue:
+    """A queue of photos to download, in a user-specific SQLite database, that
+    several worker processes can share. A worker claims a few photos at a time
+    by taking a lease on them, then acknowledges each one it downloads. If a
+    worker crashes its leases expire and the photos are claimed again by
+    another worker, up to queue_max_attempts times in all."""
+
+    def __init__(self, user_cache_dir, queue_file_name=users_queue_file_name):
+        """Opens (creating if necessary) the queue in the given directory."""
+        # Transactions are managed explicitly (see _transaction())
+        self._db_conn = sqlite3.connect(str(Path(user_cache_dir) / queue_file_name),
+                                        timeout=60, isolation_level=None)
+        self._db_conn.execute("pragma journal_mode = wal")
+        self._db_conn.execute("""create table if not exists photos (
+                                 position integer primary key,
+                                 filename text unique not null,
+                                 metadata text not null,
+                                 state text not null default 'pending',
+                                 lease_owner text,
+                                 lease_expires real,
+                                 attempts integer not null default 0,
+                                 record text)""")
+
+    def fill(self, photos_to_download):
+        """Replaces the contents of the queue with the photos in
+        photos_to_download (a dict of filename: photo_metadata_dict), to be
+        claimed in the dict's order."""
+        with self._transaction():
+            self._db_conn.execute("delete from photos")
+            self._db_conn.executemany("insert into photos (filename, metadata) values (?, ?)",
+                                      ((filename, json.dumps(photo_metadata))
+                                       for filename, photo_metadata in photos_to_download.items()))
+
+    def claim(self, owner, count=queue_claim_size, lease_time=default_lease_time):
+        """Leases up to count pending photos, or photos whose lease has
+        expired, to owner for lease_time seconds. Returns an OrderedDict of
+        filename: photo_metadata_dict of the photos claimed."""
+        now = time()
+        with self._transaction():
+            self._db_conn.execute("""update photos set state = 'failed', lease_owner = null
+                                     where state = 'leased' and lease_expires < ? and attempts >= ?""",
+                                  (now, queue_max_attempts))
+            claimed = OrderedDict((filename, json.loads(metadata)) for (filename, metadata) in self._db_conn.execute(
+                """select filename, metadata from photos
+                   where state = 'pending' or (state = 'leased' and lease_expires < ?)
+                   order by position limit ?""", (now, count)).fetchall())
+            self._db_conn.executemany("""update photos set state = 'leased', lease_owner = ?, lease_expires = ?,
+                                         attempts = attempts + 1 where filename = ?""",
+                                      ((owner, now + lease_time, filename) for filename in claimed))
+        return claimed
+
+    def renew(self, filename, owner, lease_time=default_lease_time):
+        """Extends owner's lease of the photo to lease_time seconds from now,
+        e.g. before starting its download. Returns False if owner no longer
+        holds the lease (it expired and another worker claimed the photo)."""
+        with self._transaction():
+            renewed = self._db_conn.execute("""update photos set lease_expires = ?
+                                               where filename = ? and state = 'leased' and lease_owner = ?""",
+                                            (time() + lease_time, filename, owner)).rowcount == 1
+        return renewed
+
+    def ack(self, filename, download_record):
+        """Records that the photo has been downloaded (by whichever worker)."""
+        with self._transaction():
+            self._db_conn.execute("""update photos set state = 'done', lease_owner = null, record = ?
+                                     where filename = ?""", (json.dumps(download_record), filename))
+
+    def release(self, filename, owner, retry=True):
+        """Gives up owner's lease of the photo after a failed download. It will
+        be claimed again unless retry is False or it has had too many
+        attempts."""
+        with self._transaction():
+            self._db_conn.execute("""update photos set lease_owner = null,
+                                     state = case when ? and attempts < ? then 'pending' else 'failed' end
+                                     where filename = ? and state = 'leased' and lease_owner = ?""",
+                                  (retry, queue_max_attempts, filename, owner))
+
+    def is_drained(self):
+        """Returns True if no photo is waiting to be claimed or leased."""
+        return self._db_conn.execute(
+            "select count(*) from photos where state in ('pending', 'leased')").fetchone()[0] == 0
+
+    def done_records(self):
+        """Returns a list of the download records of all downloaded photos."""
+        return [json.loads(row[0]) for row in self._db_conn.execute(
+            "select record from photos where state = 'done' order by position")]
+
+    def close(self):
+        self._db_conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """Context manager for a transaction that excludes other processes'
+        writes from its start."""
+        self._db_conn.execute("begin immediate")
+        try:
+            yield
+        except:
+            self._db_conn.execute("rollback")
+            raise
+        self._db_conn.execute("commit")
+
+class LibraryIndex:
+    """The filenames of the photos in an SQLite-based MacOS Photos library,
+    cached in the cache directory along with the highest ZADDITIONALASSETATTRIBUTES
+    primary key (Z_PK) read. Refreshing only reads rows added since, so the
+    index can be brought up to date cheaply after each import and at the start
+    of the next run. If the number of rows shows that any have been deleted
+    the whole table is read again."""
+
+    def __init__(self, photos_library, cache_dir, case_sensitive=False):
+        """Creates an index of the given library, loading any previously cached
+        index. Call refresh() before use."""
+        self._photos_sqlite_db_path = Path(photos_library) / 'database' / 'Photos.sqlite'
+        library_hash = hashlib.sha1(str(Path(photos_library).resolve()).encode()).hexdigest()[:12]
+        self._index_file_path = Path(cache_dir) / 'library-index-{}.json'.format(library_hash)
+        self._case_sensitive = case_sensitive
+        # Dict of filename: True, or None if not (yet) read
+        self.photos = None
+        self._high_water_mark = 0
+        self._row_count = 0
+        try:
+            with self._index_file_path.open('r') as index_stream:
+                index = json.load(index_stream)
+            if index['case_sensitive'] == case_sensitive:
+                self.photos = dict((filename, True) for filename in index['filenames'])
+                self._high_water_mark = index['high_water_mark']
+                self._row_count = index['row_count']
+        except (IOError, json.JSONDecodeError, KeyError):
+            pass
+
+    def key(self, filename):
+        """Returns the index key of the filename."""
+        return filename if self._case_sensitive else filename.lower()
+
+    def refresh(self, verbose=False):
+        """Reads rows added to the library since the last refresh into the
+        index. Returns a dict of filename: True of the photos added since the
+        last refresh (all of them on the first), or None if the library is not
+        SQLite-based or of unexpected format."""
+        if not self._photos_sqlite_db_path.is_file():
+            return None
+        last_high_water_mark = self._high_water_mark
+        try:
+            with sqlite3.connect(str(self._photos_sqlite_db_path)) as db_conn:
+                (row_count, ) = db_conn.execute("select count(*) from ZADDITIONALASSETATTRIBUTES").fetchone()
+                new_rows = db_conn.execute("""select Z_PK, ZORIGINALFILENAME from ZADDITIONALASSETATTRIBUTES
+                                              where Z_PK > ?""", (self._high_water_mark, )).fetchall()
+                if self.photos == None or self._row_count + len(new_rows) != row_count:
+                    # First scan, or rows have been deleted since the last
+                    if verbose >= 2:
+                        print("Reading whole library index from {}".format(self._photos_sqlite_db_path), flush=True)
+                    self.photos = dict()
+                    self._high_water_mark = 0
+                    self._row_count = 0
+                    new_rows = db_conn.execute("select Z_PK, ZORIGINALFILENAME from ZADDITIONALASSETATTRIBUTES").fetchall()
+        except sqlite3.Error:
+            return None
+
+        added_photos = dict()
+        for (primary_key, original_filename) in new_rows:
+            self.photos[self.key(str(original_filename))] = True
+            if primary_key > last_high_water_mark:
+                added_photos[self.key(str(original_filename))] = True
+            self._high_water_mark = max(self._high_water_mark, primary_key)
+        self._row_count += len(new_rows)
+        if verbose >= 2:
+            print("Read {} new rows from library index".format(len(new_rows)), flush=True)
+        return added_photos
+
+    def save(self):
+        """Caches the index in the cache directory."""
+        temp_index_file_path = self._index_file_path.with_name(self._index_file_path.name + '.tmp')
+        with temp_index_file_path.open('w') as index_stream:
+            json.dump({'case_sensitive': self._case_sensitive,
+                       'high_water_mark': self._high_water_mark,
+                       'row_count': self._row_count,
+                       'filenames': list(self.photos)}, index_stream)
+        temp_index_file_path.replace(self._index_file_path)
+
+class PhotosLibrary:
+    """A MacOS Photos library being synced into: its path, the filenames of
+    the photos already in it (if known) and its LibraryIndex (if it is
+    SQLite-based, so imports into it can be verified)."""
+
+    def __init__(self, path, photos=None, index=None, case_sensitive=False):
+        """Creates a library at path holding photos (a dict as returned by
+        list_library_photos(), or None if not inspected)."""
+        self.path = path
+        self.index = index
+        self._photos = photos
+        self._case_sensitive = case_sensitive
+
+    @property
+    def photos(self):
+        """The dict of photo-file-names in the library, or None if unknown."""
+        return self.index.photos if self.index != None else self._photos
+
+    def contains(self, filename):
+        """Returns True if the library is known to contain the photo."""
+        key = filename if self._case_sensitive else filename.lower()
+        return self.photos != None and key in self.photos
+
+    def add_photos(self, filenames):
+        """Records photos imported without verification (verified imports are
+        read into the index)."""
+        if self.index == None and self._photos != None:
+            for filename in filenames:
+                self._photos[filename if self._case_sensitive else filename.lower()] = True
+
+class RangeNotHonouredError(Exception):
+    """Raised when a segmented download requests a byte range but the server
+    responds with something other than exactly that range (e.g. the whole
+    file with a 200 status)."""
+    pass
+
 ## ############################################################################
 ## Helper methods
 ## ############################################################################
@@ -303,6 +1162,134 @@ def request_new_token(nickname,
 
     return session
 
+def parse_creation_time(media_item):
+    """Returns the creationTime of the media item as seconds since the epoch
+    or None if it is missing or badly formatted. Google formats these as UTC
+    "YYYY-MM-DDTHH:MM:SS[.fraction]Z"."""
+    try:
+        creation_time = media_item['mediaMetadata']['creationTime']
+        whole_secs, _, fraction = creation_time.rstrip('Z').partition('.')
+        creation_secs = calendar.timegm(strptime(whole_secs, '%Y-%m-%dT%H:%M:%S'))
+        return creation_secs + (float('0.' + fraction) if fraction else 0)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def list_google_media_items(session, token_persister, verbose=False, album_id=None, media_type=None,
+                            fetch_size=default_fetch_size):
+    """Generator yielding the metadata dict of each media item in the user's
+    Google Photos library or, if album_id is given, in that album, fetching
+    fetch_size media items per page. If
+    media_type is 'photo' or 'video' only media items of that type are
+    yielded. Whenever a subset is wanted mediaItems:search is used so that only
+    that subset is fetched from Google (except that Google does not allow an
+    album to be filtered by media type, so that is done here). Pages are
+    fetched as they are consumed, so only one page is held in memory at a time
+    and the caller may stop early."""
+
+    search_request = dict()
+    if album_id != None:
+        search_request['albumId'] = album_id
+    elif media_type in media_type_filters:
+        search_request['filters'] = {'mediaTypeFilter': {'mediaTypes': [media_type_filters[media_type]]}}
+    mime_type_prefix = media_type_mime_prefixes.get(media_type, '')
+
+    num_items = 0
+    page_token = None
+    while True:
+        # Token may have been refreshed (and persisted) since the last page
+        token = token_persister.load_token()
+        headers = {'Authorization': 'Bearer '+token['access_token']}
+        if search_request:
+            # pageSize goes in the request body rather than the URL
+            if page_token != None:
+                search_request['pageToken'] = page_token
+            search_request['pageSize'] = fetch_size
+            response = session.post('https://photoslibrary.googleapis.com/v1/mediaItems:search',
+                                    headers=headers, json=search_request)
+        else:
+            response = session.get('https://photoslibrary.googleapis.com/v1/mediaItems',
+                                   headers=headers, params={'pageSize': fetch_size, 'pageToken': page_token})
+        page = OrderedDict()
+        page_token = parse_get_mediaitems_response(response, page)
+        num_items += len(page)
+        for media_item in page.values():
+            if media_item.get('mimeType', '').startswith(mime_type_prefix):
+                yield media_item
+
+        # Repeat whilst Google returns a token indicating more items to come
+        if page_token == None:
+            break
+        if verbose >= 3:
+            print('Got {} photos. Fetching next page with token "..{}".'
+                  .format(num_items, page_token[-27:]), flush=True)
+        elif verbose >= 2:
+            print('Got {} photos.'.format(num_items), flush=True)
+
+def find_album_ids(session, token_persister, albums, verbose=False):
+    """Returns a list of the ids of the user's own and shared albums whose
+    title or id is one of albums. Albums not found are reported and
+    ignored."""
+
+    album_ids = OrderedDict()
+    for album_list_name in ('albums', 'sharedAlbums'):
+        params = {'pageSize': albums_page_size}
+        while True:
+            token = token_persister.load_token()
+            response = session.get('https://photoslibrary.googleapis.com/v1/' + album_list_name,
+                                   headers={'Authorization': 'Bearer '+token['access_token']},
+                                   params=params)
+            try:
+                response_content = json.loads(response.content)
+            except json.JSONDecodeError:
+                print('Badly formatted response listing {} - skipping'.format(album_list_name), flush=True)
+                break
+            for album in response_content.get(album_list_name, []):
+                for wanted_album in albums:
+                    if wanted_album in (album.get('title'), album.get('id')):
+                        album_ids[album['id']] = wanted_album
+            if 'nextPageToken' not in response_content:
+                break
+            params['pageToken'] = response_content['nextPageToken']
+
+    for wanted_album in albums:
+        if wanted_album not in album_ids.values():
+            print('Album "{}" not found - ignoring'.format(wanted_album), flush=True)
+        elif verbose >= 2:
+            print('Album "{}" found'.format(wanted_album), flush=True)
+
+    return list(album_ids)
+
+def select_photos_to_download(media_items, photo_files_on_disk, selector, case_sensitive=False, profiler=None):
+    """Compares the filename of each of the media_items (an iterable of media
+    item metadata dicts, typically as they are listed from Google) with the
+    photo_files_on_disk dict, offering each one missing from disk to the
+    DownloadSelector. Stops early if the selector can take no more. The time
+    spent comparing (rather than listing) is recorded as the diff phase.
+    Returns the number of media items inspected."""
+
+    num_photos = 0
+    diff_time = 0
+    for photo_metadata in media_items:
+        start_time = perf_counter()
+        num_photos += 1
+        filename = photo_metadata['filename']
+        if case_sensitive:
+            need_to_download = filename not in photo_files_on_disk
+        else:
+            need_to_download = filename.lower() not in photo_files_on_disk
+        
+        if need_to_download:
+            selector.offer(filename, photo_metadata)
+        diff_time += perf_counter() - start_time
+        
+        if selector.is_final:
+            # We have a maximum number allowed to download in listing order
+            break
+
+    if profiler != None:
+        profiler.add_time('diff', diff_time)
+    return num_photos
+
 def parse_get_mediaitems_response(response, photos):
     """Parses the response object from a Google API GET mediatItems request,
     adding filename: metadata entries to photos argument and returns the next
@@ -360,9 +1347,9 @@ def create_session(nickname, args, token_persister):
                     raise_on_status=False)
     session.mount('https://', HTTPAdapter(max_retries=retries))
     
-    # GET mediaItems needs Content-type header and pageSize param on every call
+    # GET mediaItems needs Content-type header on every call. pageSize is
+    # only passed where it is valid (e.g. not to mediaItems:batchGet)
     session.headers.update({'Content-type': 'application/json'})
-    session.params.update({'pageSize': args.fetch_size})
 
     # Authorization header will change on token refresh so it must be added
     # separately on each request
@@ -468,16 +1455,21 @@ end tell
 
     return photos
 
-def list_library_photos(photos_library, verbose=False, case_sensitive=False):
+def list_library_photos(photos_library, verbose=False, case_sensitive=False, library_index=None):
     """Returns a dict of all the photo-file-names in the MacOS Photos library or
     None. The key will always be the photo filename. Depending upon the library
     version, the value may be the full filepath or just True. This method will
     try several techniques for obtaining the list of photos (fastest first). If
-    all fail, None is returned."""
+    all fail, None is returned. If a LibraryIndex is supplied it is used (and
+    saved) in place of reading the whole of an SQLite-based library."""
     
     photos_library = Path(photos_library)
     
-    photos = list_library_photos_sqlite(photos_library, verbose, case_sensitive)
+    if library_index != None and library_index.refresh(verbose) != None:
+        photos = library_index.photos
+        library_index.save()
+    else:
+        photos = list_library_photos_sqlite(photos_library, verbose, case_sensitive)
     
     if photos == None:
         photos = list_library_photos_filesystem(photos_library, verbose, case_sensitive)
@@ -506,7 +1498,8 @@ def import_photos(photos_directory_to_import, photos_library, temp_cache_dir=tem
     Photos library. This method needs a temporary directory in which to store
     and run an applescript file. This tempory directory can be explicitly
     specified by temp_cache_dir, if not supplied the system default temp
-    directory will be used.""" 
+    directory will be used. Returns True if the import sub-process completed
+    successfully within process_wait_completion_time seconds.""" 
     
     temp_cache_dir = Path(temp_cache_dir).resolve()
     import_library_alias = create_macos_alias(photos_library)
@@ -556,9 +1549,11 @@ end tell
                 if verbose >=2:
                     print("Timeout after {} seconds - retrying...".format(time() - start_time), flush=True)
 
+        imported = p.poll() == 0
         if verbose >= 1:
             print("Import sub-process finished", flush=True)
     #return applescript.run(applescript_file_path, background=False)
+    return imported
    
     
 def parse_arguments():
@@ -592,7 +1587,7 @@ def parse_arguments():
     option (or manually create the directory and place a credentials file
     in it) and also force re-authentication with Google. Directory is created
     if it does not already exist. Defaults to {}.""".format(default_cache_dir),
-    metavar='DIRECTORY', default=default_cache_dir)
+    metavar='DIRECTORY', default=default_cache_dir, type=Path)
     
     # Raises error if file is specified and does not exist
     parser.add_argument('-c', '--credentials', help="""Use this application
@@ -627,30 +1622,130 @@ def parse_arguments():
     of photos from Google, retrieve in batches of this size. Defaults to {}"""
     .format(default_fetch_size), default=default_fetch_size, type=int)
     
+    parser.add_argument('-A', '--album', help="""Only sync photos in the
+    album (owned by or shared with the user) with this title or id. May be
+    given more than once to sync several albums. Only the photos in these
+    albums are fetched from Google.""", action='append', metavar='ALBUM',
+    dest='albums')
+    
+    parser.add_argument('-T', '--media-type', help="""Only sync photos or
+    only sync videos. Only media items of this type are fetched from Google
+    (unless --album is also given, in which case Google does not support
+    filtering by type so the album is fetched and filtered here). Defaults
+    to all.""", choices=['all'] + list(media_type_filters), default='all')
+    
+    parser.add_argument('-P', '--download-profile', help="""Download
+    profile to use for this run: "original" downloads original photos and
+    videos, "fast" downloads images larger than 2048 pixels scaled down to fit
+    and skips videos over 100 megabytes. Note that scaled down copies do not
+    include the original photo metadata such as location. Defaults to the
+    profile saved for each user (see --save-download-profile) or else
+    {}.""".format(default_download_profile), choices=list(download_profiles))
+    
+    parser.add_argument('--max-dimension', help="""Override the download
+    profile: download images wider or taller than this many pixels scaled
+    down to fit. Zero means always download the original.""", type=int,
+    metavar='PIXELS')
+    
+    parser.add_argument('--max-video-size', help="""Override the download
+    profile: skip videos larger than this many megabytes. Zero means no
+    limit.""", type=int, metavar='MEGABYTES')
+    
+    parser.add_argument('--save-download-profile', help="""Save the
+    --download-profile as the default for the NICKNAME users (or all users if
+    none specified) and exit.""", action='store_true')
+    
+    parser.add_argument('--upgrade-originals', help="""Instead of looking
+    for new photos, download and import the originals of photos previously
+    downloaded as scaled down copies. Photos will then contain both the
+    scaled down copy and the original.""", action='store_true')
+    
     parser.add_argument('-m', '--max-downloads', help="""Maximum number of
     photos to downlaod from Google in this execution of this program. This is
     only useful to perform a quick test_parse_args run. Negative value means no limit (the
     default).""", type=int, default=-1)
     
+    parser.add_argument('--download-order', help="""Order in which to
+    download missing photos, which also decides which are downloaded when
+    limited by --max-downloads: "listing" (the order Google lists them),
+    "newest" (most recently taken first), "smallest" (fewest pixels first,
+    photos before videos) or "photos-first". Defaults to {}."""
+    .format(default_download_order), choices=DownloadSelector.orders,
+    default=default_download_order)
+    
     parser.add_argument('-x', '--max-retries', help="""Maximum number of retries
     for each individual GET request to Google. Defaults to {}."""
     .format(default_max_retries_per_request), type=int,
     default=default_max_retries_per_request)
+
+    parser.add_argument('--segment-threshold', help="""Files larger than this
+    many megabytes (typically videos) are downloaded as several concurrent
+    byte-range segments rather than a single stream. Zero or a negative value
+    disables segmented downloads. Defaults to {}."""
+    .format(default_segment_threshold), type=int, metavar='MEGABYTES',
+    default=default_segment_threshold)
+
+    parser.add_argument('--download-segments', help="""Number of concurrent
+    segments to use for files larger than --segment-threshold. Defaults to
+    {}.""".format(default_download_segments), type=int, metavar='NUMBER',
+    default=default_download_segments)
+
+    parser.add_argument('--verify-downloads', help="""Before importing,
+    re-read every downloaded file and compare its hash with the one computed
+    while downloading. By default only file sizes are checked against the
+    download manifest.""", action='store_true')
+    
+    parser.add_argument('--profile', help="""Profile each phase of the run
+    (library scan, Google listing, diff, download and import) with cProfile
+    and tracemalloc, writing per-phase profiles, peak memory and top
+    allocation reports to a new directory under {} in the cache directory.
+    This slows the run considerably.""".format(profiles_dir_name),
+    action='store_true')
+    
+    parser.add_argument('--profile-top-allocations', help="""Number of
+    allocations to list for each phase in --profile reports. Defaults to
+    {}.""".format(default_profile_top_allocations), type=int,
+    metavar='NUMBER', default=default_profile_top_allocations)
     
     parser.add_argument('-v', '--verbose', help="""Output progress updates.
     Without this option only errors are outputted. Specify two or three times
     for even more verbose output.""", action='count')
     
     parser.add_argument('-l', '--mac-photos-library', help="""The Photos Library
-    or top level directory to scan for existing photos. Defaults to {}."""
-    .format(default_mac_photos_dir), default=default_mac_photos_dir, 
-    type=Path)
+    or top level directory to scan for existing photos. Defaults to {}. May
+    be specified more than once to sync into several libraries: photos are
+    listed and downloaded once and imported into each library missing
+    them.""".format(default_mac_photos_dir), dest='mac_photos_libraries',
+    action='append', type=Path)
     
     parser.add_argument('-k', '--keep-downloads', help="""Do not delete the
     photos downloaded from Google after importing into the MacOS Photos library.
     However, the photos will be deleted the next time this program is run.""",
     action='store_true')
     
+    parser.add_argument('-W', '--workers', help="""Download using this many
+    processes (including this one) sharing a work queue in the cache
+    directory, rather than downloading in this process alone. Cannot be used
+    with --staging-budget.""", type=int, metavar='NUMBER', default=0)
+    
+    parser.add_argument('--worker', help="""Run as an extra worker process,
+    only downloading photos queued by a run using --workers, then exit.""",
+    action='store_true')
+    
+    parser.add_argument('--lease-time', help="""Seconds a worker may take to
+    download the photos it claims from the work queue before they are
+    assumed lost and given to another worker. Defaults to {}."""
+    .format(default_lease_time), type=int, metavar='SECONDS',
+    default=default_lease_time)
+    
+    parser.add_argument('-g', '--staging-budget', help="""Maximum megabytes
+    of downloaded photos to hold on disk at once. When the next download would
+    exceed this, the photos downloaded so far are imported and deleted before
+    downloading continues. Downloads are also paused this way if free disk
+    space runs low. Cannot be used with --keep-downloads. Default is no
+    limit: all photos are downloaded before any are imported.""",
+    type=int, metavar='MEGABYTES')
+    
     parser.add_argument('-a', '--add-user', help="""Add a google user account
     to sync. Note that the NICKNAME is **not** the Google username, it merely
     distinguishes multiple Google syncs on this machine. The NICKNAME will never
@@ -672,6 +1767,19 @@ def parse_arguments():
     imported. Any --add-user and --remove-user will still be actionned.""",
     action='store_true')
     
+    parser.add_argument('--plan-out', help="""Inspect the library and list
+    and compare photos from Google as usual, but instead of downloading and
+    importing write a plan of what would be downloaded to FILE. See
+    --execute-plan.""", type=Path, metavar='FILE')
+    
+    parser.add_argument('--execute-plan', help="""Download and import the
+    photos in a plan written by --plan-out, without listing photos from
+    Google. The libraries are inspected again (cheaply for SQLite-based
+    libraries, whose index is only updated) so that photos imported since
+    the plan was made are skipped. Only the users in the plan (and in
+    NICKNAMEs, if any are specified) are synchronised. The download profile
+    is the one in effect when the plan was made.""", type=Path, metavar='FILE')
+    
     parser.add_argument('-n', '--case-sensitive', help="""Compare filenames
     using case sensitive string comparison, so "file.jpg" is considered a
     different filename to "file.JPG". Default is to ignore case.""",
@@ -686,14 +1794,40 @@ def parse_arguments():
 
     args = parser.parse_args()
     
+    # Credentials given on the command line (rather than read from the
+    # credentials file) must be passed on to --worker processes
+    args.credential_overrides = dict((name, getattr(args, name)) for name in
+                                     ('client_id', 'client_secret', 'redirect_uri', 'token_uri')
+                                     if getattr(args, name) != None)
+    if args.worker and args.client_secret == None:
+        # Passed in the environment, if at all (see worker_environment())
+        args.client_secret = os.environ.get(worker_client_secret_env_var)
+    
     if args.verbose == None:
         args.verbose = False
     
     if args.users_to_add != None and args.batch_mode:
         error_print("Cannot specify -a/--add-user and -b/--batch-mode")
     
-    if not args.mac_photos_library.is_dir():
-        error_print('{} is not a directory or Photos Library'.format(args.mac_photos_library))
+    if len([option for option in (args.plan_out, args.execute_plan, args.upgrade_originals or None)
+            if option != None]) > 1:
+        error_print("Can only specify one of --plan-out, --execute-plan and --upgrade-originals")
+    
+    if args.plan_out != None:
+        # Planning never downloads or imports
+        args.dry_run = True
+    
+    if args.staging_budget != None and args.workers > 0:
+        error_print("Cannot specify -g/--staging-budget and -W/--workers")
+    
+    if args.staging_budget != None and args.keep_downloads:
+        error_print("Cannot specify -g/--staging-budget and -k/--keep-downloads")
+    
+    if args.mac_photos_libraries == None:
+        args.mac_photos_libraries = [default_mac_photos_dir]
+    for photos_library in args.mac_photos_libraries:
+        if not photos_library.is_dir():
+            error_print('{} is not a directory or Photos Library'.format(photos_library))
     
     if not args.cache_dir.is_dir():
         args.cache_dir.mkdir(exist_ok=True)
@@ -725,6 +1859,18 @@ def parse_arguments():
                 user_cache_dir.mkdir(parents=True)
         exit_now = True
     
+    if args.save_download_profile:
+        if args.download_profile == None:
+            error_print("Must specify -P/--download-profile with --save-download-profile")
+        for nickname in get_users(args):
+            user_settings = load_user_settings(get_user_cache_dir(args, nickname))
+            user_settings['download_profile'] = args.download_profile
+            with (get_user_cache_dir(args, nickname) / users_settings_file_name).open('w') as settings_stream:
+                json.dump(user_settings, settings_stream)
+            if args.verbose:
+                print("Saved download profile {} for {}".format(args.download_profile, nickname), flush=True)
+        exit_now = True
+    
     if args.list_users:
         users = get_users(args)
         for user in users:
@@ -802,26 +1948,574 @@ def parse_arguments():
     
     return args
     
-def download_file(session, url, filename, directory, file_creation_timestamp=None, verbose=False):
+def get_download_size(session, url):
+    """Returns the size in bytes of the file at the specified URL from the
+    Content-Length of a HEAD request, or None if it cannot be determined."""
+    try:
+        response = session.head(url, allow_redirects=True)
+        response.close()
+        return int(response.headers['Content-Length'])
+    except (IOError, KeyError, ValueError):
+        return None
+
+def get_media_items(session, token_persister, media_item_ids, verbose=False):
+    """Generator yielding the current metadata dict (including a fresh
+    baseUrl) of each of the media items with the given ids, fetching up to
+    batch_get_max_ids media items per request. Media items Google cannot
+    return (e.g. since deleted) are reported in verbose output and skipped."""
+
+    media_item_ids = list(media_item_ids)
+    for start in range(0, len(media_item_ids), batch_get_max_ids):
+        token = token_persister.load_token()
+        response = session.get('https://photoslibrary.googleapis.com/v1/mediaItems:batchGet',
+                               headers={'Authorization': 'Bearer '+token['access_token']},
+                               params={'mediaItemIds': media_item_ids[start:start + batch_get_max_ids]})
+        try:
+            results = json.loads(response.content)['mediaItemResults']
+        except (json.JSONDecodeError, KeyError):
+            print('Missing mediaItemResults property in response - skipping media items', flush=True)
+            continue
+        for result in results:
+            if 'mediaItem' in result:
+                yield result['mediaItem']
+            elif verbose:
+                print('Could not get media item: {}'.format(result.get('status')), flush=True)
+
+def refresh_base_urls(session, token_persister, photos, verbose=False):
+    """Replaces the baseUrl of each of the given photo metadata dicts with a
+    fresh one from Google (base URLs expire after about an hour)."""
+
+    photos_by_id = dict((photo_metadata['id'], photo_metadata) for photo_metadata in photos
+                        if 'id' in photo_metadata)
+    for media_item in get_media_items(session, token_persister, photos_by_id, verbose):
+        if media_item.get('id') in photos_by_id:
+            photos_by_id[media_item['id']]['baseUrl'] = media_item['baseUrl']
+
+def plan_photo(photo_metadata):
+    """Returns the compact plan entry for the photo: a list of the values of
+    plan_photo_fields. The baseUrl is not included since it will have
+    expired by the time the plan is executed."""
+    media_metadata = photo_metadata.get('mediaMetadata', dict())
+    return [photo_metadata.get('id'), photo_metadata['filename'], photo_metadata.get('mimeType'),
+            media_metadata.get('width'), media_metadata.get('height'), media_metadata.get('creationTime')]
+
+def write_plan(plan_file_path, plan):
+    """Writes the sync plan (see --plan-out) to the specified file, replacing
+    any existing file only once the new plan is completely written."""
+    plan_file_path = Path(plan_file_path)
+    temp_plan_file_path = plan_file_path.with_name(plan_file_path.name + '.tmp')
+    with temp_plan_file_path.open('w') as plan_stream:
+        json.dump(plan, plan_stream, separators=(',', ':'))
+    temp_plan_file_path.replace(plan_file_path)
+
+def load_plan(plan_file_path):
+    """Returns the sync plan read from the specified file. Exits with an error
+    if it cannot be read or was written by an incompatible version."""
+    try:
+        with Path(plan_file_path).open('r') as plan_stream:
+            plan = json.load(plan_stream)
+    except (IOError, json.JSONDecodeError) as e:
+        error_print("Cannot read plan file {}\n{}".format(plan_file_path, e))
+    if plan.get('version') != plan_format_version:
+        error_print("Plan file {} is version {} but only version {} is supported"
+                    .format(plan_file_path, plan.get('version'), plan_format_version))
+    return plan
+
+def get_download_profile(args, user_cache_dir):
+    """Returns the download profile settings dict (see download_profiles) to
+    use for the user: the profile named by --download-profile, or else the one
+    saved for the user, or else the default; with any --max-dimension or
+    --max-video-size overrides applied."""
+
+    profile_name = args.download_profile
+    if profile_name == None:
+        profile_name = load_user_settings(user_cache_dir).get('download_profile', default_download_profile)
+    download_profile = dict(download_profiles.get(profile_name, download_profiles[default_download_profile]))
+    if args.max_dimension != None:
+        download_profile['max_dimension'] = args.max_dimension if args.max_dimension > 0 else None
+    if args.max_video_size != None:
+        download_profile['max_video_size'] = args.max_video_size if args.max_video_size > 0 else None
+    return download_profile
+
+def get_download_url(session, photo_metadata, download_profile, need_size=False):
+    """Returns a tuple (url, reduced, size) giving the URL from which to
+    download the photo according to the download profile, whether that is a
+    reduced copy rather than the original and the download's size in bytes.
+    The size is only fetched (with a HEAD request) if need_size is True or
+    the profile limits video sizes, and is otherwise or if unknown None. If
+    the photo should not be downloaded the tuple is (None, reason, None)."""
+
+    mime_type = photo_metadata['mimeType']
+    if mime_type.startswith('image'):
+        max_dimension = download_profile['max_dimension']
+        if max_dimension != None:
+            try:
+                metadata = photo_metadata['mediaMetadata']
+                fits = max(int(metadata['width']), int(metadata['height'])) <= max_dimension
+            except (KeyError, ValueError):
+                fits = False
+            if not fits:
+                url = photo_metadata['baseUrl']+'=w{0}-h{0}'.format(max_dimension)
+                return (url, True, get_download_size(session, url) if need_size else None)
+        url = photo_metadata['baseUrl']+'=d'
+        return (url, False, get_download_size(session, url) if need_size else None)
+    elif mime_type.startswith('video'):
+        url = photo_metadata['baseUrl']+'=dv'
+        max_video_size = download_profile['max_video_size']
+        if max_video_size == None and not need_size:
+            return (url, False, None)
+        video_size = get_download_size(session, url)
+        if max_video_size != None and video_size != None and video_size > max_video_size * 1024 * 1024:
+            return (None, 'video is {} bytes'.format(video_size), None)
+        return (url, False, video_size)
+    else:
+        return (None, 'unknown media type {}'.format(mime_type), None)
+
+def load_user_settings(user_cache_dir):
+    """Returns the dict of settings saved for the user (see
+    --save-download-profile), or an empty dict if there are none."""
+    try:
+        with (Path(user_cache_dir) / users_settings_file_name).open('r') as settings_stream:
+            return json.load(settings_stream)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return dict()
+
+def process_work_queue(work_queue, session, token_persister, user_photos_dir, download_profile, owner, args):
+    """Claims, downloads and acknowledges photos from the work queue into
+    user_photos_dir until the queue is drained, waiting for photos leased by
+    other workers in case their leases expire. Returns the number of photos
+    this worker downloaded."""
+
+    num_downloads = 0
+    while not work_queue.is_drained():
+        claimed = work_queue.claim(owner, queue_claim_size, args.lease_time)
+        if not claimed:
+            # Everything left is leased to other workers
+            sleep(process_wait_sleep_time)
+            continue
+
+        refresh_base_urls(session, token_persister, claimed.values(), args.verbose)
+        for filename, photo_metadata in claimed.items():
+            # The lease was taken for the whole batch - earlier downloads in
+            # it may have taken most of it
+            if not work_queue.renew(filename, owner, args.lease_time):
+                continue
+            (url, reduced, _) = get_download_url(session, photo_metadata, download_profile)
+            if url == None:
+                if args.verbose:
+                    print("Skipping download of {}: {}".format(filename, reduced), flush=True)
+                work_queue.release(filename, owner, retry=False)
+                continue
+
+            try:
+                file_creation_date = photo_metadata['mediaMetadata']['creationTime']
+            except:
+                file_creation_date = None
+
+            download_record = download_file(session, url, filename, user_photos_dir, file_creation_date,
+                                            args.verbose, args.segment_threshold * 1024 * 1024,
+                                            args.download_segments)
+            if download_record:
+                download_record['id'] = photo_metadata.get('id')
+                download_record['reduced'] = reduced
+                work_queue.ack(filename, download_record)
+                num_downloads += 1
+            else:
+                work_queue.release(filename, owner)
+
+    return num_downloads
+
+def download_with_workers(nickname, photos_to_download, downloaded_records, manifest, journal, args):
+    """Downloads the photos not already in downloaded_records by queueing them
+    in the user's work queue, starting args.workers - 1 worker processes and
+    working on the queue in this process too until it is drained. Further
+    workers can be started by hand with --worker. Each photo downloaded is
+    then recorded in the manifest and journal. Photos downloaded by a
+    previous, interrupted, run's workers but never recorded (as this process
+    crashed first) are recorded rather than downloaded again. Returns the
+    number of photos downloaded."""
+
+    user_cache_dir = get_user_cache_dir(args, nickname)
+    user_photos_dir = user_cache_dir / users_photos_dir_name
+    work_queue = WorkQueue(user_cache_dir)
+    num_downloads = 0
+    recorded_filenames = set(downloaded_records)
+    for download_record in work_queue.done_records():
+        filename = download_record['filename']
+        if filename in photos_to_download and filename not in recorded_filenames \
+           and (user_photos_dir / filename).exists():
+            manifest.add(download_record)
+            journal.mark_downloaded(download_record)
+            recorded_filenames.add(filename)
+            num_downloads += 1
+    work_queue.fill(OrderedDict((filename, photo_metadata) for filename, photo_metadata in photos_to_download.items()
+                                if filename not in recorded_filenames))
+
+    worker_command = [sys.executable, str(Path(__file__).resolve())] + worker_arguments(args, nickname)
+    worker_processes = [Popen(worker_command, env=worker_environment(args)) for _ in range(args.workers - 1)]
+    if args.verbose:
+        print("Started {} worker processes for user {}".format(len(worker_processes), nickname), flush=True)
+
+    token_persister = TokenPersister(user_cache_dir)
+    session = create_session(nickname, args, token_persister)
+    download_profile = journal.run_settings().get('download_profile', download_profiles[default_download_profile])
+    process_work_queue(work_queue, session, token_persister, user_photos_dir,
+                       download_profile, worker_owner_name(), args)
+    exit_codes = [worker_process.wait() for worker_process in worker_processes]
+    failed_exit_codes = [exit_code for exit_code in exit_codes if exit_code != 0]
+    if failed_exit_codes:
+        print("{} of {} worker processes for user {} failed (exit codes {}) - their unfinished downloads were left to the others"
+              .format(len(failed_exit_codes), len(worker_processes), nickname,
+                      ', '.join(str(exit_code) for exit_code in failed_exit_codes)), flush=True)
+
+    for download_record in work_queue.done_records():
+        manifest.add(download_record)
+        journal.mark_downloaded(download_record)
+        num_downloads += 1
+    work_queue.close()
+    return num_downloads
+
+def worker_arguments(args, nickname):
+    """Returns the command line arguments to start a --worker process for the
+    user with the same settings as this process. Workers read the client
+    credentials from the cached credentials file, so only those overridden
+    on the command line are passed (except the client secret, which is
+    passed in the environment - see worker_environment())."""
+    worker_args = ['--worker', '--batch-mode',
+                   '--cache-dir', str(args.cache_dir),
+                   '--max-retries', str(args.max_retries),
+                   '--fetch-size', str(args.fetch_size),
+                   '--segment-threshold', str(args.segment_threshold),
+                   '--download-segments', str(args.download_segments),
+                   '--lease-time', str(args.lease_time)]
+    for photos_library in args.mac_photos_libraries:
+        worker_args += ['--mac-photos-library', str(photos_library)]
+    for name in ('client_id', 'redirect_uri', 'token_uri'):
+        if name in args.credential_overrides:
+            worker_args += ['--' + name.replace('_', '-'), args.credential_overrides[name]]
+    if args.verbose:
+        worker_args.append('-' + 'v' * args.verbose)
+    return worker_args + [nickname]
+
+def worker_environment(args):
+    """Returns the environment in which to start a --worker process, holding
+    any client secret given on the command line (where, unlike on a worker's
+    command line, other users cannot see it)."""
+    environment = dict(os.environ)
+    if 'client_secret' in args.credential_overrides:
+        environment[worker_client_secret_env_var] = args.credential_overrides['client_secret']
+    return environment
+
+def worker_owner_name():
+    """Returns a name identifying this process in work queue leases."""
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+def run_worker(args):
+    """Entry point for a --worker process: works on the work queue of each
+    user (see download_with_workers()) until it is drained. Photos are only
+    downloaded; the process that filled the queue imports them."""
+
+    owner = worker_owner_name()
+    for nickname in get_users(args):
+        user_cache_dir = get_user_cache_dir(args, nickname)
+        if not (user_cache_dir / users_queue_file_name).exists():
+            continue
+        work_queue = WorkQueue(user_cache_dir)
+        if work_queue.is_drained():
+            work_queue.close()
+            continue
+
+        token_persister = TokenPersister(user_cache_dir)
+        session = create_session(nickname, args, token_persister)
+        if session == None:
+            print("Worker {} skipping user {} - no Google access token".format(owner, nickname), flush=True)
+            work_queue.close()
+            continue
+
+        user_photos_dir = user_cache_dir / users_photos_dir_name
+        user_photos_dir.mkdir(exist_ok=True)
+        download_profile = RunJournal(user_cache_dir).run_settings().get(
+            'download_profile', download_profiles[default_download_profile])
+        num_downloads = process_work_queue(work_queue, session, token_persister, user_photos_dir,
+                                           download_profile, owner, args)
+        work_queue.close()
+        if args.verbose:
+            print("Worker {} downloaded {} photos for user {}".format(owner, num_downloads, nickname), flush=True)
+
+def import_staged_photos(user_photos_dir, manifest, journal, nickname, args, libraries):
+    """Checks the downloaded photos in user_photos_dir against the manifest,
+    deleting any that are not vouched for, and imports the rest into each of
+    the libraries (a list of PhotosLibrary) not already containing them, or
+    into all of them when upgrading originals. Photos staged for several
+    libraries are hard linked into an import directory for those that only
+    need some of them. Photos are only recorded as imported in the journal
+    once confirmed in every library. A photo still unconfirmed after
+    import_max_attempts (e.g. one Photos rejects or skips as a duplicate) is
+    recorded as failed and moved out of user_photos_dir to be kept in the
+    user's failed directory. Returns True if there is nothing left to retry."""
+
+    # Never import anything the manifest does not vouch for
+    for bad_file_path in manifest.verify(user_photos_dir, args.verify_downloads, args.verbose):
+        bad_file_path.unlink()
+
+    filenames = [file_path.name for file_path in user_photos_dir.iterdir()]
+    if len(filenames) == 0:
+        if args.verbose:
+            print('Skiping import for user {} - no photos to import'.format(nickname), flush=True)
+        return True
+
+    import_all = journal.run_settings().get('upgrade_originals', False)
+    unconfirmed_filenames = set()
+    for library in libraries:
+        if import_all:
+            library_filenames = filenames
+        else:
+            library_filenames = [filename for filename in filenames if not library.contains(filename)]
+        if len(library_filenames) == 0:
+            continue
+
+        if args.verbose:
+            print('Importing {} photos for user {} into {}'.format(len(library_filenames), nickname, library.path),
+                  flush=True)
+        if len(library_filenames) == len(filenames):
+            missing_filenames = import_into_library(user_photos_dir, library_filenames, library, args)
+        else:
+            import_dir = user_photos_dir.parent / users_import_dir_name
+            link_photos(user_photos_dir, library_filenames, import_dir)
+            missing_filenames = import_into_library(import_dir, library_filenames, library, args)
+            shutil.rmtree(import_dir)
+
+        if missing_filenames:
+            print('{} photos for user {} were not confirmed as imported into {}'
+                  .format(len(missing_filenames), nickname, library.path), flush=True)
+            if args.verbose:
+                print('   {}'.format(', '.join(missing_filenames)), flush=True)
+        unconfirmed_filenames.update(missing_filenames)
+
+    imported_filenames = [filename for filename in filenames if filename not in unconfirmed_filenames]
+    journal.mark_imported(imported_filenames)
+    journal.update_reduced_photos(manifest.records[filename] for filename in imported_filenames
+                                  if filename in manifest.records)
+
+    # Give up on photos that have had enough attempts, so they do not keep
+    # the run from finishing
+    failed_filenames = journal.record_failed_imports(unconfirmed_filenames)
+    if failed_filenames:
+        failed_dir = user_photos_dir.parent / users_failed_dir_name
+        failed_dir.mkdir(exist_ok=True)
+        for filename in failed_filenames:
+            (user_photos_dir / filename).replace(failed_dir / filename)
+        print('Giving up importing {} photos for user {} after {} attempts - kept in {}: {}'
+              .format(len(failed_filenames), nickname, import_max_attempts, failed_dir,
+                      ', '.join(failed_filenames)), flush=True)
+
+    return len(unconfirmed_filenames) == len(failed_filenames)
+
+def import_into_library(import_dir, filenames, library, args):
+    """Imports the photos (filenames) in import_dir into the PhotosLibrary.
+    If the library has a LibraryIndex, the photos actually imported are
+    confirmed by finding them in the rows added to the library's database
+    since the import started (photos already in the library do not count),
+    and any missing are imported again up to import_retry_attempts times.
+    Otherwise the import is only confirmed by osascript succeeding. Returns
+    a list of the filenames not confirmed as imported."""
+
+    if library.index == None:
+        if not import_photos(import_dir, library.path, args.cache_dir, args.verbose):
+            return list(filenames)
+        library.add_photos(filenames)
+        return []
+
+    # Only rows added from here on can be this import
+    library.index.refresh(args.verbose)
+    imported_photos = dict()
+    imported = import_photos(import_dir, library.path, args.cache_dir, args.verbose)
+    missing_filenames = verify_import(filenames, library.index, imported_photos, imported, args.verbose)
+
+    retry_dir = import_dir.parent / users_retry_dir_name
+    for _ in range(import_retry_attempts):
+        if not missing_filenames:
+            break
+        if args.verbose:
+            print('Retrying import of {} photos not found in library'.format(len(missing_filenames)), flush=True)
+        link_photos(import_dir, missing_filenames, retry_dir)
+        imported = import_photos(retry_dir, library.path, args.cache_dir, args.verbose)
+        shutil.rmtree(retry_dir)
+        missing_filenames = verify_import(missing_filenames, library.index, imported_photos, imported, args.verbose)
+    library.index.save()
+
+    return missing_filenames
+
+def link_photos(source_dir, filenames, link_dir):
+    """Empties (creating if necessary) link_dir and hard links the photos
+    (filenames) in source_dir into it, so a subset can be imported without
+    copying them."""
+    if link_dir.exists():
+        shutil.rmtree(link_dir)
+    link_dir.mkdir()
+    for filename in filenames:
+        os.link(source_dir / filename, link_dir / filename)
+
+def verify_import(filenames, library_index, imported_photos, imported=True, verbose=False):
+    """Waits for the photos with the given filenames to appear in rows added
+    to the library index, refreshing it up to import_verify_attempts times
+    (Photos may still be writing its database after the import script has
+    finished), or just once if the import script failed (imported is False).
+    imported_photos is a dict of the photos added to the index since the
+    import started, updated by each refresh. Returns a list of the filenames
+    not found."""
+    missing_filenames = list(filenames)
+    for attempt in range(import_verify_attempts if imported else 1):
+        if attempt > 0:
+            sleep(process_wait_sleep_time)
+        added_photos = library_index.refresh(verbose)
+        if added_photos != None:
+            imported_photos.update(added_photos)
+        missing_filenames = [filename for filename in missing_filenames
+                             if library_index.key(filename) not in imported_photos]
+        if not missing_filenames:
+            break
+    if verbose >= 2:
+        print('{} of {} imported photos found in library'.format(len(filenames) - len(missing_filenames),
+                                                                 len(filenames)), flush=True)
+    return missing_filenames
+
+def download_segment(session, url, file_path, start, end, verbose=False):
+    """Downloads bytes start to end (inclusive) of the specified URL and writes
+    them at the same offset in the already preallocated file_path. Returns the
+    digest of the segment's bytes. Raises RangeNotHonouredError if the server
+    does not return exactly that range."""
+
+    response = session.get(url, stream=True,
+                           headers={'Range': 'bytes={}-{}'.format(start, end)})
+    try:
+        content_range = response.headers.get('Content-Range', '')
+        if response.status_code != 206 or not content_range.startswith('bytes {}-{}/'.format(start, end)):
+            raise RangeNotHonouredError("Requested bytes {}-{} but got status {} ({})"
+                                        .format(start, end, response.status_code, content_range))
+        written = 0
+        segment_hash = hashlib.new(download_hash_algorithm)
+        with open(file_path, 'r+b') as stream:
+            stream.seek(start)
+            for chunk in response.iter_content(chunk_size=segment_chunk_size):
+                stream.write(chunk)
+                segment_hash.update(chunk)
+                written += len(chunk)
+        if written != end - start + 1:
+            raise IOError("Segment {}-{} truncated after {} bytes".format(start, end, written))
+    finally:
+        response.close()
+
+    if verbose >= 3:
+        print("Downloaded bytes {}-{} of {}".format(start, end, url), flush=True)
+
+    return segment_hash.digest()
+
+def download_segments(session, url, file_path, total_size, segments, verbose=False):
+    """Downloads the file at the specified URL as several concurrent byte-range
+    segments, each written in place into file_path which is first preallocated
+    to total_size bytes. Each segment is hashed as it streams, so the returned
+    (hash_algorithm, hex_digest) tuple is a hash of the segment hashes (see
+    hash_file()). Raises RangeNotHonouredError if the server does not support
+    range requests and IOError if any segment is incomplete."""
+
+    with open(file_path, 'r+b') as stream:
+        stream.truncate(total_size)
+
+    segment_size = -(-total_size // segments)
+    ranges = [(start, min(start + segment_size, total_size) - 1)
+              for start in range(0, total_size, segment_size)]
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [executor.submit(download_segment, session, url, file_path, start, end, verbose)
+                   for (start, end) in ranges]
+        # Re-raises the first failure, if any, once all segments have finished
+        segment_digests = [future.result() for future in futures]
+
+    file_hash = hashlib.new(download_hash_algorithm, b''.join(segment_digests))
+    return ('{}-segments-{}'.format(download_hash_algorithm, segment_size), file_hash.hexdigest())
+
+def hash_file(file_path, hash_algorithm=download_hash_algorithm):
+    """Returns the hex digest of the file at file_path using hash_algorithm, as
+    recorded in a download manifest. This reads the whole file so is only used
+    for full verification - downloads are hashed as they stream. A hash
+    algorithm of the form "<algorithm>-segments-<size>" is the hash of the
+    concatenated hashes of each <size> byte segment (see download_segments())."""
+
+    algorithm, _, segment_size = hash_algorithm.partition('-segments-')
+    segment_size = int(segment_size) if segment_size else None
+    file_hash = hashlib.new(algorithm)
+    with open(file_path, 'rb') as stream:
+        if segment_size:
+            for segment in iter(lambda: stream.read(segment_size), b''):
+                file_hash.update(hashlib.new(algorithm, segment).digest())
+        else:
+            for chunk in iter(lambda: stream.read(segment_chunk_size), b''):
+                file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def download_file(session, url, filename, directory, file_creation_timestamp=None, verbose=False,
+                  segment_threshold=None, segments=default_download_segments):
     """Downloads a file from the specified URL to the specified destination
     directory and filename. Optionally sets the timestamp of the new file to the
     specified value which should be a string of the form "YYYY-MM-DDTHH:MM:SSZ".
+    Files of segment_threshold bytes or more are downloaded as several
+    concurrent range segments, if the server supports it, otherwise as a
+    single stream. The file is hashed and its bytes counted as it is written;
+    a download shorter or longer than the Content-Length is discarded.
+    Returns a download manifest record (a dict of filename, size, hash,
+    hash_algorithm, started and duration) or None if the download failed.
     Verbose output (if specified) is sent to stdout."""
 
     # Download
-    downloaded = False
+    record = None
+    started = time()
     if verbose:
         print("Downloading {}...".format(filename), flush=True)
     response = session.get(url, stream=True)
-    
+
     # Write to temp file, set dates, rename file to target filename
     temp_file = tempfile.NamedTemporaryFile(dir=directory, delete=False)
     temp_file_path = Path(temp_file.name)
     try:
-        with temp_file:
-            for chunk in response.iter_content(chunk_size=128):
-                temp_file.write(chunk)
-        
+        total_size = int(response.headers.get('Content-Length', 0))
+        accepts_ranges = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        segmented = False
+        if (segment_threshold and segment_threshold > 0 and segments > 1
+                and accepts_ranges and total_size >= segment_threshold):
+            # Don't read the body of the initial response - fetch in segments
+            response.close()
+            temp_file.close()
+            if verbose >= 2:
+                print("Downloading {} ({} bytes) in {} segments".format(filename, total_size, segments), flush=True)
+            try:
+                (hash_algorithm, file_hash) = download_segments(session, url, temp_file_path,
+                                                                total_size, segments, verbose)
+                size = total_size
+                segmented = True
+            except RangeNotHonouredError as e:
+                if verbose:
+                    print("Range requests not honoured for {} - downloading as single stream ({})"
+                          .format(filename, e), flush=True)
+                temp_file = temp_file_path.open('wb')
+                response = session.get(url, stream=True)
+                total_size = int(response.headers.get('Content-Length', 0))
+
+        if not segmented:
+            if response.status_code != 200:
+                raise IOError("HTTP status {}".format(response.status_code))
+            hash_algorithm = download_hash_algorithm
+            stream_hash = hashlib.new(hash_algorithm)
+            size = 0
+            with temp_file:
+                for chunk in response.iter_content(chunk_size=download_chunk_size):
+                    temp_file.write(chunk)
+                    stream_hash.update(chunk)
+                    size += len(chunk)
+            file_hash = stream_hash.hexdigest()
+            if 'Content-Length' in response.headers and size != total_size:
+                raise IOError("Got {} of {} bytes".format(size, total_size))
+
         if not file_creation_timestamp == None:
             try:
                 file_creation_time_struct = strptime(file_creation_timestamp, '%Y-%m-%dT%H:%M:%SZ')
@@ -832,15 +2526,25 @@ def download_file(session, url, filename, directory, file_creation_timestamp=Non
                     print("Error setting file date on {} ({})\n{}"
                           .format(temp_file_path, file_creation_timestamp, e), flush=True)
         temp_file_path.rename(directory / filename)
-        downloaded = True
+        record = {
+            'filename': filename,
+            'size': size,
+            'hash': file_hash,
+            'hash_algorithm': hash_algorithm,
+            'started': started,
+            'duration': time() - started,
+        }
     except Exception as e:
         if verbose >= 2:
             print("Error downloading {}: {}".format(filename, e), flush=True)
     finally:
         temp_file.close()
         response.close()
-    
-    return downloaded
+        # Never leave a partial download behind to be imported
+        if record == None and temp_file_path.exists():
+            temp_file_path.unlink()
+
+    return record
 
 def get_user_cache_dir(args, nickname):
     """Returns the path to the cache directory for the given user."""